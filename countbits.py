@@ -8,18 +8,37 @@ Released under the Creative Commons CC0 1.0 Universal Public Domain Dedication.
 
 @author      Erki Suurjaak
 @created     04.10.2012
-@modified    23.09.2015
+@modified    16.10.2026
 """
 from __future__ import print_function
 import argparse
+import array
+import bisect
 import codecs
+import collections
+import contextlib
+import datetime
 import fnmatch
 import inspect
+import io
+import itertools
+import json
 import math
+import multiprocessing
+import operator
 import os
+import Queue
+import random
 import re
+import signal
 import sqlite3
+import struct
 import sys
+import threading
+import time
+import zlib
+try: import numpy
+except ImportError: numpy = None
 
 SCRIPT_PATH = os.path.abspath(inspect.getfile(inspect.currentframe()))
 ARGUMENTS = {
@@ -28,25 +47,119 @@ ARGUMENTS = {
         {"args": ["wildcards"], "nargs": "*", "metavar": "WILDCARD",
          "help": "one or more filename patterns to match"},
         {"args": ["-d", "--directory"], "nargs": "+", "dest": "dirs",
-         "metavar": "DIR", "default": ["/"],
-         "help": "directories to process, filesystem root by default"},
+         "metavar": "DIR",
+         "help": "directories to process, filesystem root by default; "
+                 "with --statsonly, directories to show statistics for"},
         {"args": ["-nr", "--nonrecursive"], "dest": "nonrecursive",
          "action": "store_true", "help": "skip subdirectories"},
         {"args": ["-s", "--statsonly"],
          "action": "store_true", "dest": "statsonly",
          "help": "show accumulated statistics and exit"},
+        {"args": ["--metrics"], "action": "store_true", "dest": "metrics",
+         "help": "with --statsonly, also show byte entropy, text share and "
+                 "1-bit ratio per bit position, from cached byte histograms"},
+        {"args": ["--histograms"], "action": "store_true",
+         "dest": "histograms",
+         "help": "recount cached files lacking byte histograms, if engine "
+                 "provides histograms (numpy or python)"},
+        {"args": ["--rebuild"], "action": "store_true", "dest": "rebuild",
+         "help": "rebuild per-extension and per-directory statistics from "
+                 "cached files, show statistics and exit"},
+        {"args": ["--engine"], "dest": "engine", "choices": ["numpy",
+         "translate", "python"], "default": "numpy" if numpy else "translate",
+         "help": "bit counting engine: numpy byte histograms (default if "
+                 "installed), str.translate to bit counts summed by zlib "
+                 "(no byte histograms), or plain python loop"},
+        {"args": ["-j", "--jobs"], "dest": "jobs", "metavar": "N",
+         "type": int, "default": 1,
+         "help": "number of files to count concurrently in separate processes"},
+        {"args": ["--readahead"], "dest": "readahead", "metavar": "BLOCKS",
+         "type": int, "default": 0,
+         "help": "number of 1MB blocks to read ahead in a background thread "
+                 "while counting, if single job, for overlapping slow reads "
+                 "with counting on several CPUs (default 0, disabled)"},
         {"args": ["--db"], "dest": "dbpath",
          "default": os.path.join(os.path.dirname(SCRIPT_PATH), "countbits.db"),
          "help": "cache-database path, by default in program directory. "
                  "Use :memory: or empty string for no caching."},
+        {"args": ["--sample"], "action": "store_true", "dest": "sample",
+         "help": "estimate ratios from blocks read at random offsets, "
+                 "until reaching target precision, without caching counts"},
+        {"args": ["--precision"], "dest": "precision", "metavar": "RATIO",
+         "type": float, "default": 0.001,
+         "help": "target margin of sampled ratio at 95%% confidence "
+                 "(default %(default)s)"},
+        {"args": ["--sampleblock"], "dest": "sampleblock", "metavar": "BYTES",
+         "type": int, "default": 4096,
+         "help": "size of sampled blocks (default %(default)s)"},
+        {"args": ["--estimate"], "action": "store_true", "dest": "estimate",
+         "help": "walk directories for total size before counting, "
+                 "to show estimated time remaining"},
+        {"args": ["--stats-json"], "dest": "statsjson", "metavar": "FILE",
+         "help": "write scan counters, rates and phase times to JSON file "
+                 "at exit"},
+        {"args": ["--batch"], "dest": "batchsize", "metavar": "N",
+         "type": int, "default": 1000,
+         "help": "number of database writes to commit in one transaction "
+                 "(default %(default)s)"},
+        {"args": ["--batchtime"], "dest": "batchtime", "metavar": "SECONDS",
+         "type": float, "default": 5,
+         "help": "maximum seconds to keep writes uncommitted "
+                 "(default %(default)s)"},
     ],
 }
 CHAR_HIGHBITS = dict((chr(i), 0) for i in range(256))  # {char: 1-bit count}
 for i in range(len(CHAR_HIGHBITS)):
     CHAR_HIGHBITS[chr(i)] = (i & 1) + CHAR_HIGHBITS[chr(i >> 1)]
-DB_INITSQL = ("CREATE TABLE IF NOT EXISTS files (path TEXT NOT NULL PRIMARY KEY, "
-              "extension TEXT, zeroes INTEGER, ones INTEGER, mtime INTEGER, "
-              "dt TIMESTAMP DEFAULT (STRFTIME('%Y-%m-%d %H:%M:%f', 'now')))")
+CHAR_HIGHBITS_TABLE = "".join(chr(CHAR_HIGHBITS[chr(i)]) for i in range(256))
+ADLER_CHUNK = 8189 # Bytes of 1-bit counts summing to less than Adler-32 modulus
+BYTE_HIGHBITS = numpy.array(map(ord, CHAR_HIGHBITS_TABLE)) if numpy else None
+DB_INITSQL = """
+CREATE TABLE IF NOT EXISTS files (path TEXT NOT NULL PRIMARY KEY,
+  extension TEXT, zeroes INTEGER, ones INTEGER, mtime INTEGER,
+  dt TIMESTAMP DEFAULT (STRFTIME('%Y-%m-%d %H:%M:%f', 'now')),
+  histogram BLOB);
+CREATE TABLE IF NOT EXISTS extensions (extension TEXT PRIMARY KEY,
+  files INTEGER NOT NULL DEFAULT 0, zeroes INTEGER NOT NULL DEFAULT 0,
+  ones INTEGER NOT NULL DEFAULT 0);
+CREATE TABLE IF NOT EXISTS directories (path TEXT NOT NULL,
+  extension TEXT NOT NULL, files INTEGER NOT NULL DEFAULT 0,
+  zeroes INTEGER NOT NULL DEFAULT 0, ones INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY (path, extension));
+CREATE TABLE IF NOT EXISTS samples (run TIMESTAMP, paths TEXT,
+  extension TEXT, samples INTEGER, bytes INTEGER, ones REAL, margin REAL);
+CREATE TRIGGER IF NOT EXISTS files_after_insert AFTER INSERT ON files BEGIN
+  INSERT OR IGNORE INTO extensions (extension) VALUES (NEW.extension);
+  UPDATE extensions SET files = files + 1, zeroes = zeroes + NEW.zeroes,
+    ones = ones + NEW.ones WHERE extension IS NEW.extension;
+END;
+CREATE TRIGGER IF NOT EXISTS files_after_delete AFTER DELETE ON files BEGIN
+  UPDATE extensions SET files = files - 1, zeroes = zeroes - OLD.zeroes,
+    ones = ones - OLD.ones WHERE extension IS OLD.extension;
+  DELETE FROM extensions WHERE extension IS OLD.extension AND files < 1;
+END;
+CREATE TRIGGER IF NOT EXISTS files_after_update AFTER UPDATE ON files BEGIN
+  UPDATE extensions SET files = files - 1, zeroes = zeroes - OLD.zeroes,
+    ones = ones - OLD.ones WHERE extension IS OLD.extension;
+  INSERT OR IGNORE INTO extensions (extension) VALUES (NEW.extension);
+  UPDATE extensions SET files = files + 1, zeroes = zeroes + NEW.zeroes,
+    ones = ones + NEW.ones WHERE extension IS NEW.extension;
+  DELETE FROM extensions WHERE extension IS OLD.extension AND files < 1;
+END;
+"""
+DB_REBUILDSQL = """
+DELETE FROM extensions;
+INSERT INTO extensions (extension, files, zeroes, ones)
+  SELECT extension, COUNT(*), COALESCE(SUM(zeroes), 0), COALESCE(SUM(ones), 0)
+  FROM files GROUP BY extension;
+"""
+TEXT_BYTES = [9, 10, 13] + range(32, 127) # Printable ASCII and whitespace
+PROGRESS_INTERVAL = 0.2 # Minimum seconds between progress redraws
+SAMPLE_MIN = 100  # Minimum number of samples before checking precision
+SAMPLE_Z = 1.96   # Standard score for 95% confidence interval
+DB_MAXPARAMS = 500 # Maximum number of parameters per SQL query
+DB_PRAGMAS = ["PRAGMA journal_mode = WAL", "PRAGMA synchronous = FULL",
+              "PRAGMA cache_size = -16384", "PRAGMA temp_store = MEMORY"]
 
 
 
@@ -64,18 +177,273 @@ def find_files(paths=(".",), wildcards=("*",), recursive=True):
             if not recursive: break # for root, dirs, files
 
 
-def get_filebits(filepath, BLOCKSIZE=81920):
-    """Returns (zerobit-count, onebit-count) for the specified file."""
-    zeroes, ones = 0, 0
+def count_numpy(data):
+    """Returns (1-bit count, [count per byte value]) for data, via NumPy."""
+    counts = numpy.bincount(numpy.frombuffer(data, numpy.uint8), minlength=256)
+    return int(numpy.dot(counts, BYTE_HIGHBITS)), counts.tolist()
+
+
+def count_translate(data):
+    """
+    Returns (1-bit count, None) for data, via translating bytes to counts
+    and summing these with Adler-32 over chunks short enough for its
+    first component (1 + sum of bytes, modulo 65521) never to wrap.
+    """
+    data = data if isinstance(data, (str, bytearray)) else str(data)
+    data = data.translate(CHAR_HIGHBITS_TABLE)
+    offsets = xrange(0, len(data), ADLER_CHUNK)
+    return sum(zlib.adler32(buffer(data, i, ADLER_CHUNK)) & 0xFFFF
+               for i in offsets) - len(offsets), None
+
+
+def count_python(data):
+    """
+    Returns (1-bit count, [count per byte value]) for data,
+    via a Python loop over bytes.
+    """
+    counts = collections.defaultdict(int)
+    for x in buffer(data): counts[x] += 1
+    return (sum(CHAR_HIGHBITS[x] * n for x, n in counts.items()),
+            [counts.get(chr(i), 0) for i in range(256)])
+
+
+ENGINES = {"numpy": count_numpy, "translate": count_translate,
+           "python": count_python}
+HISTOGRAM_ENGINES = ["numpy", "python"] # Engines providing byte histograms
+
+
+def count_blocks(blocks, engine="translate", tick=None):
+    """
+    Returns (zerobit-count, onebit-count, byte histogram or None) for data
+    blocks, histogram being a packed BLOB if the engine provides counts
+    per byte value.
+
+    @param   engine  bit counting engine, one of ENGINES
+    @param   tick    function to call with block size after each block,
+                     if any
+    """
+    zeroes, ones, histogram, count = 0, 0, None, ENGINES[engine]
+    for data in blocks:
+        n, counts = count(data)
+        ones, zeroes = ones + n, zeroes + 8 * len(data) - n
+        if counts: histogram = counts if histogram is None else \
+                               map(operator.add, histogram, counts)
+        if tick: tick(len(data))
+    return zeroes, ones, histogram and pack_histogram(histogram)
+
+
+def read_blocks(filepath, blocksize=1048576):
+    """Yields data blocks from file, stopping silently on error."""
     try:
         with open(filepath, "rb") as f:
-            data = f.read(BLOCKSIZE)
-            while data:
-                count = sum(CHAR_HIGHBITS[x] for x in data)
-                ones, zeroes = ones + count, zeroes + 8 * len(data) - count
-                data = f.read(BLOCKSIZE)
+            for data in iter(lambda: f.read(blocksize), ""): yield data
     except EnvironmentError: pass
-    return zeroes, ones
+
+
+def get_filebits(filepath, engine="translate"):
+    """
+    Returns (zerobit-count, onebit-count, byte histogram or None)
+    for the specified file.
+
+    @param   engine  bit counting engine, one of ENGINES
+    """
+    return count_blocks(read_blocks(filepath), engine)
+
+
+def pack_histogram(counts):
+    """
+    Returns 256 counts per byte value as a BLOB of little-endian
+    unsigned integers, 32-bit if all counts fit, else 64-bit.
+    """
+    fmt = "<256I" if max(counts) < 2**32 else "<256Q"
+    return struct.pack(fmt, *counts)
+
+
+def unpack_histogram(blob):
+    """Returns [count per byte value] from a packed histogram BLOB."""
+    blob = str(blob)
+    return list(struct.unpack("<256I" if len(blob) < 2048 else "<256Q", blob))
+
+
+def imap_readahead(iterable, blocks=8, stats=None, tick=None,
+                   BLOCKSIZE=1048576, FILES=1024):
+    """
+    Yields (key, get_filebits() result) for each (key, (filepath, engine))
+    in iterable, like imap_ordered(get_filebits, iterable), with files
+    read ahead in a background thread while counting, up to FILES files
+    queued ahead.
+
+    @param   blocks  number of reusable read buffers
+    @param   stats   dictionary to update with seconds spent
+                     {"counting", "waiting": for reads, "reading": in thread},
+                     if any
+    @param   tick    function to call with block size after each block
+                     counted, if any
+    """
+    reader, pending = ReadAhead(blocks, BLOCKSIZE), collections.deque()
+    iterable, counting = iter(iterable), 0
+    try:
+        while True:
+            for key, (filepath, engine) in iterable:
+                reader.add(filepath)
+                pending.append((key, engine))
+                if len(pending) >= FILES: break # for key
+            if not pending: break # while True
+            key, engine = pending.popleft()
+            clock, waiting = time.time(), reader.waiting
+            result = count_blocks(reader.blocks(), engine, tick)
+            counting += time.time() - clock - (reader.waiting - waiting)
+            yield key, result
+    finally:
+        reader.close()
+        if stats is not None: stats.update(counting=counting,
+            waiting=reader.waiting, reading=reader.reading)
+
+
+def imap_ordered(func, iterable, jobs=1, tick=None):
+    """
+    Yields (key, func(*args)) for each (key, args) in iterable, in iterable
+    order. With more than one job, calls run concurrently in a process pool,
+    with up to twice as many results in flight as there are jobs.
+    Worker processes ignore Ctrl-C, leaving it to the calling process.
+
+    @param   tick  function to call periodically while waiting for
+                   results from worker processes, if any
+    """
+    def get(result):
+        """Returns result, waiting at most interval at a time for tick."""
+        while tick and not result.ready():
+            result.wait(PROGRESS_INTERVAL)
+            tick()
+        return result.get(sys.maxint) # Timeout for Ctrl-C
+
+    if jobs < 2:
+        for key, args in iterable: yield key, func(*args)
+        return
+    pool = multiprocessing.Pool(jobs, signal.signal,
+                                (signal.SIGINT, signal.SIG_IGN))
+    pending = collections.deque()
+    try:
+        for key, args in iterable:
+            pending.append((key, pool.apply_async(func, args)))
+            if len(pending) >= 2 * jobs:
+                key, result = pending.popleft()
+                yield key, get(result)
+        while pending:
+            key, result = pending.popleft()
+            yield key, get(result)
+    finally:
+        pool.terminate()
+
+
+class ReadAhead(object):
+    """
+    Reads files in a background thread into a bounded pool of reusable
+    buffers, yielding blocks to consumer in order of added files.
+    Small files get read one after another into the same buffer, and
+    blocks are passed to consumer in batches, a buffer's worth at a time
+    or whenever the thread would wait for more files or free buffers.
+    """
+
+    STOP = object() # Last item from background thread
+
+    def __init__(self, blocks=8, blocksize=1048576):
+        """
+        @param   blocks     number of buffers, limiting how far to read ahead
+        @param   blocksize  size of one buffer
+        """
+        self.reading = 0 # Seconds spent reading in background thread
+        self.waiting = 0 # Seconds consumer has spent waiting for blocks
+        self._running = True
+        self._error  = None          # sys.exc_info() of thread failure, if any
+        self._files  = Queue.Queue() # Filepaths to read
+        self._free   = Queue.Queue() # Buffers available for reading into
+        self._blocks = Queue.Queue() # Batches of blocks read, as lists of
+                                     # (buffer, offset, size, last in buffer),
+                                     # or None at end of file
+        self._taken  = collections.deque() # Blocks from last batch
+        for _ in range(blocks): self._free.put(bytearray(blocksize))
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def add(self, filepath):
+        """Queues file for reading."""
+        self._files.put(filepath)
+
+
+    def blocks(self):
+        """
+        Yields blocks read from next added file, as buffers or buffer views
+        valid until next iteration, when buffer may be taken for reuse.
+        Waits for blocks without timeout, as timed waits poll with sleeps:
+        background thread always passes on blocks before it would wait.
+        """
+        while True:
+            if not self._taken:
+                try: self._taken.extend(self._blocks.get_nowait())
+                except Queue.Empty:
+                    clock = time.time()
+                    self._taken.extend(self._blocks.get())
+                    self.waiting += time.time() - clock
+            item = self._taken.popleft()
+            if item is None: break # while True
+            if item is self.STOP:
+                self._taken.appendleft(item)
+                if self._error: raise self._error[0], self._error[1], \
+                                      self._error[2]
+                break # while True
+            data, offset, size, last = item
+            whole = not offset and size == len(data) # Spare a copy for str()
+            yield data if whole else buffer(data, offset, size)
+            if last: self._free.put(data)
+
+
+    def close(self):
+        """Stops background thread, waiting for it to finish current read."""
+        self._running = False
+        self._files.put(None)
+        self._free.put(None)
+        self._thread.join()
+
+
+    def _run(self):
+        """Reads added files into free buffers, until closed."""
+        batch, data, offset = [], None, 0 # Buffer being filled, at offset
+
+        def take(queue):
+            """Returns next item from queue, passing on batch before waiting."""
+            try: return queue.get_nowait()
+            except Queue.Empty:
+                if batch: self._blocks.put(batch[:]); del batch[:]
+                return queue.get()
+
+        try:
+            while self._running:
+                filepath = take(self._files)
+                if filepath is None: break # while self._running
+                try:
+                    with io.open(filepath, "rb", buffering=0) as f:
+                        while True:
+                            if data is None:
+                                data, offset = take(self._free), 0
+                                if data is None: return
+                            clock = time.time()
+                            size = f.readinto(memoryview(data)[offset:])
+                            self.reading += time.time() - clock
+                            if not size: break # while True
+                            offset += size
+                            last = offset >= len(data)
+                            batch.append((data, offset - size, size, last))
+                            if last:
+                                self._blocks.put(batch[:]); del batch[:]
+                                data = None
+                except EnvironmentError: pass
+                batch.append(None)
+        except Exception: self._error = sys.exc_info()
+        finally: self._blocks.put(batch + [self.STOP])
+
 
 
 def format_bytes(size, precision=2, inter=" "):
@@ -101,26 +469,214 @@ def shorten_path(path, length=20):
     return result
 
 
-def print_progress(totals, filepath):
-    """Prints out current progress and running stats."""
-    bits = float(totals["zeroes"] + totals["ones"])
-    safediv = lambda a, b: a/b if b else 0
-    t = "\rFiles: {0:>7,d}   Size: {1:>7}   Zeroes/ones: {2: 3.0%} vs {3: 3.0%}   {4}"
-    print(t.format(totals["files"], format_bytes(bits / 8, 1, ""),
-          safediv(totals["zeroes"], bits), safediv(totals["ones"], bits),
-          shorten_path(filepath, 16)), end=" ")
-
-
-def print_stats(db):
-    """Prints out complete accumulated statistics."""
-    stats, totals = {}, {}
-    sql1 = ("SELECT COUNT(*) AS files, COALESCE(SUM(zeroes), 0) "
-            "AS zeroes, COALESCE(SUM(ones), 0) AS ones FROM files")
-    sql2 = ("SELECT extension, COUNT(*) AS files, "
-            "COALESCE(SUM(zeroes), 0) AS zeroes, "
-            "COALESCE(SUM(ones), 0) AS ones FROM files GROUP BY extension")
-    for x in db.execute(sql1): totals.update(x)
-    for x in db.execute(sql2): stats[x["extension"]] = dict(x)
+def format_duration(seconds):
+    """Returns seconds formatted like "1:02:03"."""
+    minutes, seconds = divmod(int(seconds), 60)
+    return "%d:%02d:%02d" % (divmod(minutes, 60) + (seconds, ))
+
+
+class Progress(object):
+    """
+    Tracks scan counters and time spent per phase, redrawing status line
+    at a fixed rate at most. Phase "read" is file input, "count" is bit
+    counting and waiting for worker results.
+    """
+    PHASES = ["walk", "stat", "read", "count", "db"]
+
+    def __init__(self, totals, interval=PROGRESS_INTERVAL, estimate=None):
+        """
+        @param   totals    running {"files", "zeroes", "ones"} of cache
+        @param   interval  minimum seconds between status redraws
+        @param   estimate  total size of files to process, for remaining time
+        """
+        self.totals, self.interval, self.estimate = totals, interval, estimate
+        self.counts = dict.fromkeys(["files", "bytes", "cached", "cachedbytes"],
+                                    0) # Files counted and cache hits, this run
+        self.times = dict.fromkeys(self.PHASES, 0.) # {phase: seconds}
+        self.start = self._since = time.time()
+        self._phase, self._drawn, self._filepath = "count", 0, ""
+        self._partial = 0 # Bytes counted so far in current file
+
+
+    def switch(self, phase):
+        """Attributes time since last switch to current phase, returns it."""
+        now, previous = time.time(), self._phase
+        self.times[previous] += now - self._since
+        self._phase, self._since = phase, now
+        return previous
+
+
+    @contextlib.contextmanager
+    def timing(self, phase):
+        """Context manager attributing time spent inside to given phase."""
+        previous = self.switch(phase)
+        try: yield
+        finally: self.switch(previous)
+
+
+    def timed(self, iterable, phase):
+        """Yields items from iterable, attributing iteration time to phase."""
+        iterable = iter(iterable)
+        while True:
+            with self.timing(phase):
+                try: item = next(iterable)
+                except StopIteration: break # while True
+            yield item
+
+
+    def add(self, filepath, size, cached=False):
+        """Registers a file as counted or found in cache, redraws if due."""
+        self.counts["cached" if cached else "files"] += 1
+        self.counts["cachedbytes" if cached else "bytes"] += size
+        self._filepath, self._partial = filepath, 0
+        self.draw()
+
+
+    def advance(self, size):
+        """Registers bytes counted in current file, redraws if due."""
+        self._partial += size
+        self.draw()
+
+
+    def get_stats(self):
+        """Returns {"elapsed", "files", "bytes", "cached", .., "times"}."""
+        self.switch(self._phase)
+        elapsed = time.time() - self.start
+        done = self.counts["files"] + self.counts["cached"]
+        result = dict(self.counts, elapsed=elapsed, times=dict(self.times),
+                      filerate=self.counts["files"] / elapsed if elapsed else 0,
+                      byterate=self.counts["bytes"] / elapsed if elapsed else 0,
+                      cacheratio=float(self.counts["cached"]) / done if done else 0)
+        if self.estimate is not None: result["estimate"] = self.estimate
+        return result
+
+
+    def draw(self, force=False):
+        """Prints status line, if forced or interval has passed."""
+        if not force and time.time() - self._drawn < self.interval: return
+        stats, totals = self.get_stats(), self.totals
+        stats["bytes"] += self._partial
+        stats["byterate"] = stats["bytes"] / stats["elapsed"] \
+                            if stats["elapsed"] else 0
+        bits = float(totals["zeroes"] + totals["ones"])
+        safediv = lambda a, b: a/b if b else 0
+        t = "\r{0:>7,d} files {1:>5.0f}/s  {2:>7} {3:>7}/s  {4:>4.0%} cached  {5:.0%}/{6:.0%}"
+        line = t.format(stats["files"], stats["filerate"],
+                        format_bytes(stats["bytes"], 1, ""),
+                        format_bytes(stats["byterate"], 1, ""),
+                        stats["cacheratio"], safediv(totals["zeroes"], bits),
+                        safediv(totals["ones"], bits))
+        done = stats["bytes"] + stats["cachedbytes"]
+        if self.estimate and done:
+            remaining = stats["elapsed"] * max(0, self.estimate - done) / done
+            line += "  ETA " + format_duration(remaining)
+        line += "  " + shorten_path(self._filepath, max(10, 79 - len(line)))
+        print(line, end=" ")
+        self._drawn = time.time()
+
+
+def open_db(dbpath):
+    """Returns an SQLite connection to given path, with schema created."""
+    db = sqlite3.connect(dbpath, isolation_level=None)  # Explicit transactions
+    for sql in DB_PRAGMAS: db.execute(sql)
+    init_db(db)
+    db.row_factory = sqlite3.Row
+    return db
+
+
+def init_db(db):
+    """
+    Creates database tables and triggers if missing, populating
+    per-extension and per-directory statistics and adding histogram column
+    for a cache predating them.
+    """
+    sql = "SELECT name FROM sqlite_master WHERE type = 'table'"
+    existed = set(x[0] for x in db.execute(sql))
+    db.executescript(DB_INITSQL)
+    if "extensions" not in existed: db.executescript(DB_REBUILDSQL)
+    if "directories" not in existed: rebuild_directories(db)
+    columns = [x[1] for x in db.execute("PRAGMA table_info(files)")]
+    if "histogram" not in columns: db.execute("ALTER TABLE files ADD COLUMN histogram BLOB")
+
+
+def get_parents(path):
+    """Yields all parent directories of path, up to filesystem root."""
+    parent = os.path.dirname(path)
+    while True:
+        yield parent
+        if os.path.dirname(parent) == parent: break # while True
+        parent = os.path.dirname(parent)
+
+
+def add_directories(deltas, path, extension, files, zeroes, ones):
+    """
+    Adds file counts to all parent directories of path in deltas,
+    as {(directory, extension): [files, zeroes, ones]}.
+    """
+    for parent in get_parents(path):
+        x = deltas.setdefault((parent, extension), [0, 0, 0])
+        x[0], x[1], x[2] = x[0] + files, x[1] + zeroes, x[2] + ones
+
+
+def update_directories(db, deltas):
+    """
+    Adds {(directory, extension): [files, zeroes, ones]} to rolled-up
+    directory statistics, and clears deltas.
+    """
+    for (path, ext), (files, zeroes, ones) in deltas.items():
+        args = [files, zeroes, ones, path, ext]
+        db.execute("INSERT OR IGNORE INTO directories (path, extension) "
+                   "VALUES (?, ?)", [path, ext])
+        db.execute("UPDATE directories SET files = files + ?, zeroes = "
+                   "zeroes + ?, ones = ones + ? WHERE path = ? AND "
+                   "extension = ?", args)
+        if files < 0: db.execute("DELETE FROM directories WHERE path = ? "
+                                 "AND extension = ? AND files < 1", args[3:])
+    deltas.clear()
+
+
+def rebuild_directories(db):
+    """Recalculates rolled-up directory statistics from cached files."""
+    deltas = {}
+    for path, ext, zeroes, ones in db.execute("SELECT path, extension, "
+                                              "zeroes, ones FROM files"):
+        add_directories(deltas, path, ext, 1, zeroes, ones)
+    db.execute("BEGIN")
+    db.execute("DELETE FROM directories")
+    update_directories(db, deltas)
+    db.execute("COMMIT")
+
+
+def get_totals(db):
+    """Returns accumulated {"files", "zeroes", "ones"} over all extensions."""
+    sql = ("SELECT COALESCE(SUM(files), 0) AS files, COALESCE(SUM(zeroes), 0) "
+           "AS zeroes, COALESCE(SUM(ones), 0) AS ones FROM extensions")
+    return dict(db.execute(sql).fetchone())
+
+
+def print_stats(db, paths=None):
+    """
+    Prints out complete accumulated statistics.
+
+    @param   paths  directories to limit statistics to, if any
+    """
+    if paths:
+        stats, paths = {}, sorted(set(os.path.abspath(unicode(x)) for x in paths))
+        sql = "SELECT * FROM directories WHERE path = ?"
+        for path in paths:
+            if any(x != path and path.startswith(os.path.join(x, ""))
+                   for x in paths):
+                continue # for path, as subdirectory of another path
+            for x in db.execute(sql, [path]):
+                data = stats.setdefault(x["extension"], dict.fromkeys(
+                                        ["files", "zeroes", "ones"], 0))
+                for k in data: data[k] += x[k]
+        totals = dict((k, sum(x[k] for x in stats.values()))
+                      for k in ("files", "zeroes", "ones"))
+    else:
+        totals = get_totals(db)
+        stats = dict((x["extension"], dict(x))
+                     for x in db.execute("SELECT * FROM extensions"))
     safediv = lambda a, b: a/b if b else 0
 
     bits = float(totals["zeroes"] + totals["ones"])
@@ -142,50 +698,320 @@ def print_stats(db):
               byteslen=byteslen, fileslen=fileslen))
 
 
-def countbits(paths=("/",), wildcards=("*",), recursive=True,
-              dbpath=":memory:", statsonly=False):
-    """Processes detected files for bitcount, prints statistics."""
-    db = sqlite3.connect(dbpath, isolation_level=None)  # Auto-commit
-    db.execute(DB_INITSQL)
-    db.row_factory = sqlite3.Row
+def get_metrics(counts):
+    """
+    Returns metrics derived from byte histogram, as {"entropy": bits per byte,
+    "text": share of printable ASCII and whitespace,
+    "bits": [1-bit ratio per bit position from highest to lowest]}.
+    """
+    total = float(sum(counts))
+    entropy = sum(x / total * math.log(total / x, 2) for x in counts if x)
+    text = sum(counts[i] for i in TEXT_BYTES) / total
+    bits = [sum(x for i, x in enumerate(counts) if i & (1 << j)) / total
+            for j in range(7, -1, -1)]
+    return {"entropy": entropy, "text": text, "bits": bits}
+
 
-    if statsonly: return print_stats(db)
+def print_metrics(db, paths=None):
+    """
+    Prints out metrics derived from cached byte histograms.
 
-    dbfiles = dict((x["path"], dict(x)) for x in db.execute("SELECT * FROM files"))
-    totals = {"zeroes": 0, "ones": 0, "files": 0}
-    for x in db.execute("SELECT COUNT(*) AS files, COALESCE(SUM(zeroes), 0) "
-                        "AS zeroes, COALESCE(SUM(ones), 0) AS ones FROM files"):
-        totals.update(x)
+    @param   paths  directories to limit metrics to, if any
+    """
+    histograms, missing = {}, 0 # {extension or None for all: [counts]}
+    sql, args = "SELECT extension, histogram FROM files", []
+    if paths:
+        paths = sorted(set(os.path.join(os.path.abspath(unicode(x)), "")
+                           for x in paths))
+        paths = [x for x in paths if not any(x != y and x.startswith(y)
+                                             for y in paths)]
+        sql += " WHERE " + " OR ".join(["(path > ? AND path < ?)"] * len(paths))
+        for x in paths: args += [x, x[:-1] + unichr(ord(x[-1]) + 1)]
+    for x in db.execute(sql, args):
+        if x["histogram"] is None:
+            missing += 1
+            continue # for x
+        counts = unpack_histogram(x["histogram"])
+        for key in None, x["extension"]:
+            histograms[key] = map(operator.add, histograms[key], counts) \
+                              if key in histograms else counts
 
-    def is_skippable(p, mtime, size):
+    t = u"{0:>14}   {1:>7}   {2:>4}   {3}"
+    print("\n" + t.format("", "ENTROPY", "TEXT", "1-BIT RATIO BY BIT 7..0"))
+    print("-" * 79)
+    order = lambda (ext, counts): (ext is not None, -sum(counts))
+    for ext, counts in sorted(histograms.items(), key=order):
+        metrics = get_metrics(counts)
+        print(t.format("TOTAL" if ext is None else ("." + ext) if ext
+                       else "<NO EXTENSION>",
+                       "{:.2f}".format(metrics["entropy"]),
+                       "{:.0%}".format(metrics["text"]),
+                       " ".join("{:>4.0%}".format(x) for x in metrics["bits"])))
+    if missing: print("\n%s cached files lack byte histograms (translate "
+                      "engine or older cache), to be recounted on next scan "
+                      "with --histograms and numpy or python engine."
+                      % missing)
+
+
+def countbits(paths=None, wildcards=("*",), recursive=True,
+              dbpath=":memory:", statsonly=False, engine="translate", jobs=1,
+              batchsize=1000, batchtime=5, rebuild=False, readahead=0,
+              metrics=False, estimate=False, statsjson=None,
+              histograms=False):
+    """
+    Processes detected files for bitcount, prints statistics.
+
+    @param   paths      directories to process, filesystem root if None;
+                        with statsonly, directories to limit statistics to
+    @param   engine     bit counting engine, one of ENGINES
+    @param   jobs       number of files to count concurrently in worker
+                        processes, results being written by this process only
+    @param   batchsize  number of database writes to commit in one transaction
+    @param   batchtime  maximum seconds to keep writes uncommitted
+    @param   rebuild    rebuild per-extension and per-directory statistics
+                        from cached files, print statistics and exit
+    @param   readahead  number of 1MB blocks to read ahead in a background
+                        thread while counting, if single job
+    @param   metrics    print metrics derived from byte histograms, if
+                        statsonly
+    @param   estimate   walk directories for total size before counting,
+                        to show estimated time remaining
+    @param   statsjson  path of JSON file to write scan counters, rates
+                        and phase times to at exit, if any
+    @param   histograms  recount cached files lacking byte histograms,
+                         if engine provides histograms
+    """
+    db = open_db(dbpath)
+    batch = {"count": 0, "start": None} # Uncommitted writes
+    deltas = {} # Uncommitted {(directory, extension): [files, zeroes, ones]}
+
+    def commit():
+        """Commits current batch with directory statistics, if any."""
+        if batch["count"]:
+            update_directories(db, deltas)
+            db.execute("COMMIT")
+        batch["count"] = 0
+
+    def write(sql, args=()):
+        """Executes a write in the current batch, committing a full batch."""
+        if not batch["count"]:
+            db.execute("BEGIN")
+            batch["start"] = time.time()
+        db.execute(sql, args)
+        batch["count"] += 1
+        elapsed = time.time() - batch["start"]
+        if batch["count"] >= batchsize or elapsed >= batchtime: commit()
+
+    def tick(size=0):
+        """
+        Advances progress by bytes counted, commits current batch
+        if open longer than batchtime.
+        """
+        progress.advance(size)
+        if batch["count"] and time.time() - batch["start"] >= batchtime:
+            with progress.timing("db"): commit()
+
+    if rebuild:
+        db.executescript(DB_REBUILDSQL)
+        rebuild_directories(db)
+    if statsonly or rebuild:
+        print_stats(db, paths if statsonly else None)
+        if statsonly and metrics: print_metrics(db, paths)
+        return
+
+    totals, paths = get_totals(db), paths or ["/"]
+    size = None
+    if estimate:
+        print("Estimating total size..", end=" ")
+        size = sum(os.path.getsize(x) for x in
+                   find_files(paths, wildcards, recursive))
+        print(format_bytes(size))
+    progress = Progress(totals, estimate=size)
+
+    def get_cached(filepaths):
+        """Returns {path: row dict} for cached files, by indexed lookup."""
+        result = {}
+        for i in range(0, len(filepaths), DB_MAXPARAMS):
+            chunk = filepaths[i:i + DB_MAXPARAMS]
+            sql = "SELECT * FROM files WHERE path IN (%s)" % \
+                  ", ".join("?" * len(chunk))
+            with progress.timing("db"):
+                result.update((x["path"], dict(x))
+                              for x in db.execute(sql, chunk))
+        return result
+
+    def is_skippable(p, mtime, size, cached):
         """Returns whether to skip the file for bitcount processing."""
         result = not bool(size)
-        if p in dbfiles:
-            lastsize = (dbfiles[p]["zeroes"] + dbfiles[p]["ones"]) / 8
-            result = (mtime == dbfiles[p]["mtime"] and size == lastsize)
+        if cached:
+            lastsize = (cached["zeroes"] + cached["ones"]) / 8
+            result = (mtime == cached["mtime"] and size == lastsize and
+                      (cached["histogram"] is not None or not histograms or
+                       engine not in HISTOGRAM_ENGINES))
             if not result:
-                db.execute("DELETE FROM files WHERE path = ?", [p])
+                add_directories(deltas, p, cached["extension"], -1,
+                                -cached["zeroes"], -cached["ones"])
+                with progress.timing("db"):
+                    write("DELETE FROM files WHERE path = ?", [p])
                 for k in "zeroes", "ones", "files": 
-                    totals[k] -= dbfiles[p].get(k, 1)
+                    totals[k] -= cached.get(k, 1)
+            else: progress.add(p, size, cached=True)
         return result
 
+    def get_files():
+        """
+        Yields ((filepath, mtime), (filepath, engine)) for files to count,
+        looking up cached files one directory at a time.
+        """
+        files = find_files(paths, wildcards, recursive)
+        for _, filepaths in itertools.groupby(progress.timed(files, "walk"),
+                                              os.path.dirname):
+            filepaths = list(filepaths)
+            dbfiles = get_cached(filepaths)
+            for filepath in filepaths:
+                with progress.timing("stat"): st = os.stat(filepath)
+                mtime, size = st.st_mtime, st.st_size
+                cached = dbfiles.pop(filepath, None)
+                skip = is_skippable(filepath, mtime, size, cached)
+                tick()
+                if skip: continue # for filepath
+                yield (filepath, mtime), (filepath, engine)
+
+    times = {} # {"counting": seconds, "waiting": .., "reading": ..}
+    if jobs < 2 and readahead > 0:
+        results = imap_readahead(get_files(), readahead, times, tick)
+    elif jobs < 2: # Like get_filebits(), with reads timed apart from counting
+        results = ((key, count_blocks(progress.timed(read_blocks(filepath),
+                                                     "read"), engine, tick))
+                   for key, (filepath, engine) in get_files())
+    else: results = imap_ordered(get_filebits, get_files(), jobs, tick)
+    counted = progress.timed(results, "count")
     try:
-        for filepath in find_files(paths, wildcards, recursive):
-            mtime, size = os.path.getmtime(filepath), os.path.getsize(filepath)
-            if is_skippable(filepath, mtime, size): continue # for filepath
-            print_progress(totals, filepath)
-            zeroes, ones = get_filebits(filepath)
+        for (filepath, mtime), (zeroes, ones, histogram) in counted:
             if not (zeroes or ones): continue # for filepath
 
             ext = os.path.splitext(filepath)[1][1:].lower()
-            db.execute("INSERT INTO files (path, extension, zeroes, ones, mtime) "
-                       "VALUES (?, ?, ?, ?, ?)", [filepath, ext, zeroes, ones, mtime])
+            histogram = histogram and sqlite3.Binary(histogram)
+            add_directories(deltas, filepath, ext, 1, zeroes, ones)
+            with progress.timing("db"):
+                write("INSERT INTO files (path, extension, zeroes, ones, "
+                      "mtime, histogram) VALUES (?, ?, ?, ?, ?, ?)",
+                      [filepath, ext, zeroes, ones, mtime, histogram])
             for k, v in ("zeroes", zeroes), ("ones", ones), ("files", 1):
                 totals[k] += v
-            print_progress(totals, filepath)
+            progress.add(filepath, (zeroes + ones) // 8)
     except KeyboardInterrupt: pass
     finally:
+        with progress.timing("db"): commit()
+        results.close()
+        if times: # Consumer waiting on background reads is input time
+            progress.times["count"] -= times["waiting"]
+            progress.times["read"]  += times["waiting"]
+        progress.draw(force=True)
         print_stats(db)
+        stats = dict(progress.get_stats(), paths=paths, engine=engine,
+                     jobs=jobs, readahead=times or None,
+                     started=datetime.datetime.fromtimestamp(progress.start)
+                                              .isoformat())
+        print("\nCounted %s files, %s in %s: %.1f files/s, %s/s, %.0f%% "
+              "cache hits." % (stats["files"], format_bytes(stats["bytes"]),
+              format_duration(stats["elapsed"]), stats["filerate"],
+              format_bytes(stats["byterate"]), 100 * stats["cacheratio"]))
+        print("Time spent: %s." % ", ".join("%s %.1fs" % (k, stats["times"][k])
+                                             for k in Progress.PHASES))
+        if times: print("Reading ahead: counting %.1fs, waiting for reads "
+                        "%.1fs, reading %.1fs." % (times["counting"],
+                        times["waiting"], times["reading"]))
+        if statsjson:
+            with open(statsjson, "w") as f:
+                json.dump(stats, f, indent=2, sort_keys=True)
+
+
+def get_estimate(stats):
+    """
+    Returns (1-bit ratio, margin at 95% confidence) from sample stats
+    [samples, sum of ratios, sum of squared ratios, ..].
+    """
+    n, total, squares = stats[:3]
+    mean = total / n
+    variance = max(0, squares - n * mean * mean) / (n - 1) if n > 1 else 0
+    return mean, SAMPLE_Z * math.sqrt(variance / n) if n > 1 else 1
+
+
+def sample_bits(paths=("/",), wildcards=("*",), recursive=True,
+                dbpath=":memory:", engine="translate", precision=0.001,
+                blocksize=4096):
+    """
+    Estimates bit ratios from blocks at random byte offsets in detected files,
+    sampling files by size, until overall margin at 95% confidence is within
+    precision. Prints and stores results apart from exact counts.
+
+    Each sampled block is picked with probability proportional to its length,
+    so the mean of block ratios estimates the ratio over all bytes.
+
+    @param   engine     bit counting engine, one of ENGINES
+    @param   precision  target margin for 1-bit ratio
+    @param   blocksize  size of sampled blocks
+    """
+    filepaths, ends, total = [], array.array("d"), 0 # ends: cumulative sizes
+    for filepath in find_files(paths, wildcards, recursive):
+        size = os.path.getsize(filepath)
+        if not size: continue # for filepath
+        total += size
+        filepaths.append(filepath)
+        ends.append(total)
+
+    db, started = open_db(dbpath), time.strftime("%Y-%m-%d %H:%M:%S")
+    stats = {} # {extension or None for all: [samples, sum, sum of squares, bytes]}
+    count, misses, drawn = ENGINES[engine], 0, 0
+    try:
+        while total and misses < 1000:
+            offset = random.randrange(total)
+            i = bisect.bisect_right(ends, offset)
+            filepath, offset = filepaths[i], offset - (ends[i - 1] if i else 0)
+            try:
+                with open(filepath, "rb") as f:
+                    f.seek(int(offset) // blocksize * blocksize)
+                    data = f.read(blocksize)
+            except EnvironmentError: data = None
+            misses = 0 if data else misses + 1
+            if not data: continue # while total
+
+            ratio = count(data)[0] / (8. * len(data))
+            ext = os.path.splitext(filepath)[1][1:].lower()
+            for key in None, ext:
+                x = stats.setdefault(key, [0, 0., 0., 0])
+                x[0], x[1], x[2], x[3] = (x[0] + 1, x[1] + ratio,
+                                          x[2] + ratio * ratio, x[3] + len(data))
+            ones, margin = get_estimate(stats[None])
+            done = stats[None][0] >= SAMPLE_MIN and margin <= precision
+            if done or time.time() - drawn >= PROGRESS_INTERVAL:
+                t = ("\rSamples: {0:>7,d}   Read: {1:>7}   "
+                     "Zeroes/ones: {2: 5.1%} vs {3: 5.1%} +-{4:.2%}")
+                print(t.format(stats[None][0],
+                      format_bytes(stats[None][3], 1, ""),
+                      1 - ones, ones, margin), end=" ")
+                drawn = time.time()
+            if done: break # while total
+    except KeyboardInterrupt: pass
+    if not stats: return print("\n\nNo data to sample.")
+
+    ones, margin = get_estimate(stats[None])
+    t = u"{0:>14}   {1:>5.1%} vs {2:>5.1%} +-{3:.2%}   {4:>10,d} samples of {5} in {6:,d} files"
+    print("\n\n" + t.format("TOTAL ZERO/ONE", 1 - ones, ones, margin,
+          stats[None][0], format_bytes(total), len(filepaths)))
+    print("-" * 79)
+    t = u"{0:>14}   {1:>5.1%} vs {2:>5.1%} +-{3:.2%}   {4:>10,d} samples"
+    for ext, x in sorted(stats.items(), key=lambda x: -x[1][0]):
+        if ext is None: continue # for ext, x
+        ones, margin = get_estimate(x)
+        print(t.format(("." + ext) if ext else "<NO EXTENSION>",
+                       1 - ones, ones, margin, x[0]))
+
+    sql = ("INSERT INTO samples (run, paths, extension, samples, bytes, ones, "
+           "margin) VALUES (?, ?, ?, ?, ?, ?, ?)")
+    db.executemany(sql, [(started, json.dumps(paths), ext, x[0], x[3])
+                         + get_estimate(x) for ext, x in stats.items()])
 
 
 
@@ -195,7 +1021,11 @@ if "__main__" == __name__:
     args = parser.parse_args()
     args.paths, args.recursive = args.dirs, not args.nonrecursive
     del args.nonrecursive; del args.dirs
+    sample, precision, blocksize = args.sample, args.precision, args.sampleblock
+    del args.sample; del args.precision; del args.sampleblock
 
     enc = sys.stdout.encoding or "utf-8"
     sys.stdout = codecs.getwriter(enc)(sys.stdout, errors="replace")
-    countbits(**vars(args))
+    if sample: sample_bits(args.paths or ["/"], args.wildcards, args.recursive,
+                           args.dbpath, args.engine, precision, blocksize)
+    else: countbits(**vars(args))
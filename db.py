@@ -13,6 +13,26 @@ Simple convenience wrapper for SQLite.
     db.execute("DROP TABLE test")
 
 
+Bulk inserts and upserts take an iterable of dicts, or of value sequences
+with column names, and run in batches within a single transaction:
+
+    db.insertmany("test", ({"val": i} for i in range(1000)))
+    db.insertmany("test", [(1001, "a"), (1002, "b")], cols=["id", "val"])
+    db.upsertmany("test", [{"id": 1, "val": "x"}, {"id": 2000, "val": "y"}],
+                  keys=["id"])
+
+
+Statements can be grouped into a transaction, committed at the end or rolled
+back on error; nested transactions use savepoints. Group-commit mode commits
+and starts anew after every N statements or T milliseconds:
+
+    with db.transaction():
+        db.insert("test", val="a")
+        with db.transaction(): db.delete("test", val="b")
+    with db.transaction(count=1000, interval=500):
+        for i in range(100000): db.insert("test", val=i)
+
+
 Keyword arguments are added to WHERE clause, or to VALUES clause for INSERT:
 
     myid = db.insert("test", val="oh")
@@ -58,17 +78,32 @@ Default row factory is dict, can be overridden via Database.row_factory:
     mydb.row_factory = sqlite3.Row
 
 
+Generated SQL is cached by query shape: action, table, columns, WHERE columns
+and operators, IN-list lengths, GROUP BY, ORDER BY and LIMIT. Cache usage
+is counted in db.SQL_CACHE_STATS {"hits", "misses"}.
+
+
 ------------------------------------------------------------------------------
 Released under the Creative Commons CC0 1.0 Universal Public Domain Dedication.
 
 @author      Erki Suurjaak
 @created     05.03.2014
-@modified    26.09.2015
+@modified    16.10.2026
 """
 import collections
+import contextlib
+import itertools
 import os
 import re
 import sqlite3
+import threading
+import time
+
+
+SQL_CACHE = collections.OrderedDict() # {query shape: (SQL, [param name, ])}
+SQL_CACHE_SIZE = 1000 # Maximum number of query shapes to cache
+SQL_CACHE_STATS = {"hits": 0, "misses": 0} # makeSQL() cache usage counters
+SQL_CACHE_LOCK = threading.Lock() # Guards cache changes across connections
 
 
 def init(path=None, init_statements=None):
@@ -104,6 +139,23 @@ def insert(table, values=(), **kwargs):
     return init().insert(table, values, **kwargs)
 
 
+def insertmany(table, rows, cols=None, batch=1000):
+    """
+    Convenience wrapper for database bulk INSERT, returns inserted count.
+    Rows can be dicts, or value sequences in the order of cols.
+    """
+    return init().insertmany(table, rows, cols, batch)
+
+
+def upsertmany(table, rows, keys, cols=None, batch=1000):
+    """
+    Convenience wrapper for database bulk INSERT-or-UPDATE,
+    returns inserted or updated row count.
+    Rows can be dicts, or value sequences in the order of cols.
+    """
+    return init().upsertmany(table, rows, keys, cols, batch)
+
+
 def select(table, cols="*", where=(), group=(), order=(), limit=(), **kwargs):
     """
     Convenience wrapper for database SELECT, returns sqlite3.Cursor.
@@ -133,6 +185,17 @@ def execute(sql, args=None):
     return init().execute(sql, args)
 
 
+def transaction(count=None, interval=None):
+    """
+    Returns a transaction context manager, committing on exit
+    and rolling back on error. Nested transactions use savepoints.
+
+    @param   count     commit and start anew after this many statements
+    @param   interval  commit and start anew after this many milliseconds
+    """
+    return init().transaction(count, interval)
+
+
 def close():
     """Closes the default database connection, if any."""
     try: init().close()
@@ -166,6 +229,7 @@ class Database(object):
         conn = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES,
             isolation_level=None, check_same_thread=False)
         self._path, self._connection = path, conn
+        self._depth, self._group = 0, None # Transaction nesting and batching
         self._row_factory = lambda cursor, row: dict(sqlite3.Row(cursor, row))
         conn.row_factory = lambda cursor, row: self.row_factory(cursor, row)
         if isinstance(statements, basestring): statements = [statements]
@@ -209,6 +273,64 @@ class Database(object):
         return self.execute(sql, args).lastrowid
 
 
+    def insertmany(self, table, rows, cols=None, batch=1000):
+        """
+        Convenience wrapper for database bulk INSERT, returns inserted count.
+        Statement is prepared once and rows are inserted in batches
+        within a single transaction, rolled back on error.
+
+        @param   rows   iterable of dicts, or of value sequences
+        @param   cols   column names for value sequences,
+                        all table columns in order if None;
+                        keys of the first row if rows are dicts
+        @param   batch  number of rows per executemany()
+        """
+        rows = iter(rows)
+        first = next(rows, None)
+        if first is None: return 0
+        named = isinstance(first, dict)
+        cols = list(first) if named and not cols else cols
+        if not cols:
+            cursor = self._connection.cursor()
+            cursor.row_factory = None
+            sql = "PRAGMA table_info(%s)" % table
+            cols = [x[1] for x in cursor.execute(sql)]
+        sql = makeManySQL("INSERT", table, cols, named)
+        rows = itertools.chain([first], rows)
+        return self._executemany([sql], rows, batch)
+
+
+    def upsertmany(self, table, rows, keys, cols=None, batch=1000):
+        """
+        Convenience wrapper for database bulk INSERT-or-UPDATE, inserting
+        new rows and updating existing ones, returns affected row count.
+        Statement is prepared once and rows are processed in batches
+        within a single transaction, rolled back on error.
+
+        @param   rows   iterable of dicts, or of value sequences
+        @param   keys   column names identifying existing rows,
+                        needing a UNIQUE constraint or index in table
+        @param   cols   column names for value sequences,
+                        keys of the first row if rows are dicts
+        @param   batch  number of rows per executemany()
+        """
+        rows = iter(rows)
+        first = next(rows, None)
+        if first is None: return 0
+        named = isinstance(first, dict)
+        cols = list(first) if named and not cols else cols
+        if not cols: raise ValueError("Column names required for upsert.")
+        keys = [keys] if isinstance(keys, basestring) else list(keys)
+        rows = itertools.chain([first], rows)
+        if sqlite3.sqlite_version_info < (3, 24): # No native UPSERT syntax
+            if not named: rows = (dict(zip(cols, x)) for x in rows)
+            actions = ["UPDATE"] if set(cols) - set(keys) else [] # Any to SET
+            actions += ["INSERT OR IGNORE"] # Updated rows get ignored
+            sqls = [makeManySQL(x, table, cols, True, keys) for x in actions]
+        else: sqls = [makeManySQL("UPSERT", table, cols, named, keys)]
+        return self._executemany(sqls, rows, batch)
+
+
     def select(self, table, cols="*", where=(), group=(), order=(), limit=(),
                **kwargs):
         """
@@ -245,7 +367,76 @@ class Database(object):
 
     def execute(self, sql, args=None):
         """Executes the SQL and returns sqlite3.Cursor."""
-        return self._connection.execute(sql, args or {})
+        cursor = self._connection.execute(sql, args or {})
+        if self._group: self._flush(1)
+        return cursor
+
+
+    @contextlib.contextmanager
+    def transaction(self, count=None, interval=None):
+        """
+        Returns a transaction context manager, committing on exit
+        and rolling back on error. Nested transactions use savepoints.
+
+        Group-commit mode commits and starts a new transaction after given
+        number of statements or milliseconds, checked after each statement
+        and only applied to the outermost transaction; on error, only the
+        statements since the last commit are rolled back.
+
+        @param   count     commit and start anew after this many statements
+        @param   interval  commit and start anew after this many milliseconds
+        """
+        name = "tx%s" % self._depth
+        self._connection.execute("SAVEPOINT %s" % name)
+        if not self._depth and (count or interval):
+            self._group = {"count": count, "interval": interval,
+                           "statements": 0, "start": time.time()}
+        self._depth += 1
+        try:
+            yield self
+        except BaseException: # Including KeyboardInterrupt and SystemExit
+            try:
+                self._connection.execute("ROLLBACK TO %s" % name)
+                self._connection.execute("RELEASE %s" % name)
+            except sqlite3.Error: pass # Already rolled back by SQLite
+            raise
+        else:
+            self._connection.execute("RELEASE %s" % name)
+        finally:
+            self._depth -= 1
+            if not self._depth: self._group = None
+        if self._group: self._flush(0)
+
+
+    def _flush(self, statements):
+        """
+        Adds statement count to group-commit mode, commits and starts anew
+        if count or interval reached and no savepoints are open.
+        """
+        group = self._group
+        group["statements"] += statements
+        if 1 != self._depth or not (
+            group["count"] and group["statements"] >= group["count"] or
+            group["interval"] and
+            (time.time() - group["start"]) * 1000 >= group["interval"]
+        ): return
+        self._connection.execute("RELEASE tx0")
+        self._connection.execute("SAVEPOINT tx0")
+        group.update(statements=0, start=time.time())
+
+
+    def _executemany(self, sqls, rows, batch):
+        """
+        Executes each SQL statement on each batch of rows in a transaction,
+        returns total affected row count.
+        """
+        result = 0
+        with self.transaction():
+            for chunk in iter(lambda: list(itertools.islice(rows, batch)), []):
+                for sql in sqls:
+                    result += self._connection.executemany(sql, chunk).rowcount
+        if self._group: self._flush(result)
+        return result
 
 
     def close(self):
@@ -258,43 +449,86 @@ class Database(object):
 
 def makeSQL(action, table, cols="*", where=(), group=(), order=(), limit=(),
             values=()):
-    """Returns (SQL statement string, parameter dict)."""
+    """
+    Returns (SQL statement string, parameter dict).
+    SQL is cached by query shape, only parameters are collected per call.
+    """
     action = action.upper()
+    cols   =     cols if isinstance(cols,  basestring) else tuple(cols)
+    group  =    group if isinstance(group, basestring) else tuple(group)
+    order  = (order,) if isinstance(order, basestring) else tuple(
+             tuple(x) if isinstance(x, list) else x for x in order) \
+             if order else ()
+    limit  = (limit,) if isinstance(limit, (basestring, int)) else tuple(limit)
+    values = values.items() if isinstance(values, dict) else values
+    where  =  where.items() if isinstance(where,  dict) else where
+    values = values if action in ("INSERT", "UPDATE") else () # Else unused
+    valcols, params = (tuple(x[0] for x in values), [x[1] for x in values]) \
+                      if values else ((), [])
+    shape = [] # [(col, op, IN-list length or whether value is None), ]
+    for col, val in where:
+        dbval = val[1] if isinstance(val, (list, tuple)) else val
+        op = "IS" if dbval == val else val[0]
+        if op.upper() in ("IN", "NOT IN"):
+            shape.append((col, op, len(dbval)))
+            params.extend(dbval)
+        else:
+            shape.append((col, op, dbval is None))
+            params.append(dbval)
+    key = (action, table, cols, valcols, tuple(shape), group, order, limit)
+    try: cached = SQL_CACHE.get(key)
+    except TypeError: key = cached = None # Unhashable argument
+    SQL_CACHE_STATS["hits" if cached else "misses"] += 1
+    if not cached:
+        cached = makeShapeSQL(action, table, cols, shape, group, order, limit,
+                              valcols)
+        if key is not None:
+            with SQL_CACHE_LOCK:
+                while len(SQL_CACHE) >= SQL_CACHE_SIZE:
+                    SQL_CACHE.popitem(False)
+                SQL_CACHE[key] = cached
+    sql, names = cached
+    return sql, dict(zip(names, params))
+
+
+def makeShapeSQL(action, table, cols="*", where=(), group=(), order=(),
+                 limit=(), values=()):
+    """
+    Returns (SQL statement string, [parameter name, ]), parameter names
+    in the order of values and then WHERE values, with IN-lists expanded.
+
+    @param   where   [(col, op, IN-list length or whether value is None), ]
+    @param   values  column names for INSERT or UPDATE
+    """
     cols   =    cols if isinstance(cols,  basestring) else ", ".join(cols)
     group  =   group if isinstance(group, basestring) else ", ".join(group)
-    order  = [order] if isinstance(order, basestring) else order
-    limit  = [limit] if isinstance(limit, (basestring, int)) else limit
-    values = values if not isinstance(values, dict) else values.items()
-    where  =  where if not isinstance(where, dict)  else where.items()
     sql = "SELECT %s FROM %s" % (cols, table) if "SELECT" == action else ""
     sql = "DELETE FROM %s"    % (table)       if "DELETE" == action else sql
     sql = "INSERT INTO %s"    % (table)       if "INSERT" == action else sql
     sql = "UPDATE %s"         % (table)       if "UPDATE" == action else sql
-    args = {}
+    names = []
     if "INSERT" == action:
-        args.update(values)
-        cols, vals = (", ".join(x + k for k, v in values) for x in ("", ":"))
+        names.extend(values)
+        cols, vals = (", ".join(x + k for k in values) for x in ("", ":"))
         sql += " (%s) VALUES (%s)" % (cols, vals)
     if "UPDATE" == action:
         sql += " SET "
-        for i, (col, val) in enumerate(values):
+        for i, col in enumerate(values):
             sql += (", " if i else "") + "%s = :%sU%s" % (col, col, i)
-            args["%sU%s" % (col, i)] = val
+            names.append("%sU%s" % (col, i))
     if where:
         sql += " WHERE "
-        for i, (col, val) in enumerate(where):
+        for i, (col, op, arg) in enumerate(where):
             key = "%sW%s" % (re.sub("\\W", "_", col), i)
-            dbval = val[1] if isinstance(val, (list, tuple)) else val
-            op = "IS" if dbval == val else val[0]
-            op = "=" if dbval is not None and "IS" == op.upper() else op
             if op.upper() in ("IN", "NOT IN"):
                 keys = ["%sW%s_%s" % (re.sub("\\W", "_", col), i, j)
-                        for j in range(len(dbval))]
-                args.update(zip(keys, dbval))
+                        for j in range(arg)]
+                names.extend(keys)
                 sql += (" AND " if i else "") + "%s %s (%s)" % (
                         col, op, ", ".join(":" + x for x in keys))
             else:
-                args[key] = dbval
+                op = "=" if not arg and "IS" == op.upper() else op
+                names.append(key)
                 sql += (" AND " if i else "") + "%s %s :%s" % (col, op, key)
     if group:
         sql += " GROUP BY " + group
@@ -308,7 +542,34 @@ def makeSQL(action, table, cols="*", where=(), group=(), order=(), limit=(),
             sql += (", " if i else "") + name + direction
     if limit:
         sql += " LIMIT %s" % (", ".join(map(str, limit)))
-    return sql, args
+    return sql, names
+
+
+def makeManySQL(action, table, cols, named=True, keys=()):
+    """
+    Returns SQL statement string for executemany(), with parameters
+    as :col for named or ? for positional.
+
+    @param   action  "INSERT", "INSERT OR IGNORE", "INSERT OR REPLACE",
+                     "UPDATE" with cols not in keys set and keys in WHERE,
+                     or "UPSERT" for INSERT with ON CONFLICT (keys) DO UPDATE
+    @param   keys    key columns for UPDATE and UPSERT
+    """
+    action = action.upper()
+    mark = lambda c: ":" + c if named else "?"
+    if "UPDATE" == action:
+        sets = [c for c in cols if c not in keys]
+        return "UPDATE %s SET %s WHERE %s" % (table,
+               ", ".join("%s = %s" % (c, mark(c)) for c in sets),
+               " AND ".join("%s = %s" % (c, mark(c)) for c in keys))
+    sql = "%s INTO %s (%s) VALUES (%s)" % (
+          "INSERT" if "UPSERT" == action else action, table,
+          ", ".join(cols), ", ".join(map(mark, cols)))
+    if "UPSERT" == action:
+        sets = ["%s = excluded.%s" % (c, c) for c in cols if c not in keys]
+        sql += " ON CONFLICT (%s) DO %s" % (", ".join(keys),
+               "UPDATE SET " + ", ".join(sets) if sets else "NOTHING")
+    return sql
 
 
 
@@ -323,6 +584,9 @@ if "__main__" == __name__:
     print("Updated %s row where val is NULL." % db.update("test", {"val": "new"}, val=None))
     print("Select where val IN [0, 1, 2]: %s." % db.fetchall("test", val=("IN", range(3))))
     print("Delete %s row where val=0." % db.delete("test", val=0))
+    print("Inserted %s rows in bulk." % db.insertmany("test", ({"val": i} for i in range(10, 15))))
+    print("Upserted %s rows in bulk." % db.upsertmany("test", [(1, "one"), (100, "hundred")], keys="id", cols=["id", "val"]))
     print("Fetch all, order by val: %s." % db.fetchall("test", order="val"))
     db.execute("DROP TABLE test")
+    print("SQL cache usage: %s." % db.SQL_CACHE_STATS)
     db.close()
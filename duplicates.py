@@ -7,16 +7,33 @@ Released under the Creative Commons CC0 1.0 Universal Public Domain Dedication.
 
 @author      Erki Suurjaak
 @created     23.02.2015
-@modified    23.09.2015
+@modified    16.10.2026
 """
 import argparse
+import array
+import binascii
 import codecs
 import collections
+import ctypes
+import ctypes.util
 import fnmatch
+import gzip
+import hashlib
+import heapq
+import itertools
+import json
 import math
+import mmap
+import multiprocessing.pool
 import os
 import re
+import socket
+import sqlite3
+import stat
+import struct
 import sys
+import threading
+import time
 
 TYPEGROUPS = {
     "audio": ["*." + x for x in "aac aif aifc aiff alac ape au flac m4a mp1 "
@@ -31,7 +48,7 @@ ARGUMENTS = {
     "arguments": [
         {"args": ["wildcards"], "nargs": "*", "metavar": "WILDCARD",
          "help": "one or more filename patterns to match"},
-        {"args": ["-d", "--directory"], "nargs": "+", "dest": "dirs",
+        {"args": ["-d", "--directory"], "nargs": "+", "dest": "directories",
          "metavar": "DIR", "default": [os.getcwd()],
          "help": "directories to process, defaults to working directory"},
         {"args": ["-t", "--type"], "nargs": "+", "dest": "types",
@@ -41,68 +58,1008 @@ ARGUMENTS = {
          "action": "store_true", "dest": "recursive"},
         {"args": ["-s", "--sizeonly"], "help": "match by file size only",
          "action": "store_true", "dest": "sizeonly"},
+        {"args": ["--noprefilter"], "dest": "noprefilter",
+         "action": "store_true",
+         "help": "skip sampled-fingerprint prefilter before full comparison"},
+        {"args": ["--cache"], "dest": "cache", "metavar": "DBPATH",
+         "help": "SQLite database for caching file fingerprints and hashes, "
+                 "to only read new or modified files on later runs"},
+        {"args": ["--maxopen"], "dest": "maxopen", "metavar": "N",
+         "type": int, "help": "maximum number of files to keep open at once "
+                              "in comparison, reopening files as needed"},
+        {"args": ["-j", "--jobs"], "dest": "jobs", "metavar": "N",
+         "type": int, "default": 1,
+         "help": "number of size groups to compare concurrently"},
+        {"args": ["--maxblock"], "dest": "maxblock", "metavar": "BYTES",
+         "type": int, "default": 8388608,
+         "help": "maximum number of bytes to read from a file at once, "
+                 "as read size grows while files keep matching (default 8MB)"},
+        {"args": ["--engine"], "dest": "engine", "default": "read",
+         "choices": ["read", "mmap"],
+         "help": "file comparison engine: read blocks from streams (default), "
+                 "or compare memory-mapped files in place"},
+        {"args": ["--dirs"], "dest": "dirs", "action": "store_true",
+         "help": "report directories of duplicate content as a whole, at "
+                 "the highest level, instead of their files one by one"},
+        {"args": ["--watch"], "dest": "watch", "action": "store_true",
+         "help": "keep watching directories after scan, reporting new "
+                 "duplicates as files get written (Linux only)"},
+        {"args": ["--manifest"], "dest": "manifest", "metavar": "FILE",
+         "help": "write a manifest of scanned files with sizes, "
+                 "modification times, fingerprints and hashes, and exit"},
+        {"args": ["--nomanifesthash"], "dest": "nomanifesthash",
+         "action": "store_true",
+         "help": "write full hashes to manifest only for files up to 64 KB "
+                 "or cached, for a faster manifest; --merge can then "
+                 "verify larger files only on local host"},
+        {"args": ["--merge"], "nargs": "+", "dest": "merge",
+         "metavar": "MANIFEST",
+         "help": "list duplicates across manifest files from one or more "
+                 "hosts, rereading local files only where hash is missing"},
     ],
 }
+SAMPLE_COUNT = 8     # Number of content samples taken for a file fingerprint
+SAMPLE_SIZE  = 4096  # Bytes read per content sample
+SAMPLE_MINSIZE = 2 * SAMPLE_COUNT * SAMPLE_SIZE # Smaller files are not sampled
+POSIX_FADV_SEQUENTIAL = 2
+try: posix_fadvise = os.posix_fadvise # Py3
+except AttributeError:
+    try: # Py2 on POSIX systems
+        posix_fadvise = ctypes.CDLL(ctypes.util.find_library("c")).posix_fadvise
+        posix_fadvise.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64,
+                                  ctypes.c_int]
+    except Exception: posix_fadvise = None
+DB_PRAGMAS = ["PRAGMA journal_mode = WAL", "PRAGMA synchronous = NORMAL"]
+DB_BATCHSIZE = 1000 # Number of cache writes to commit in one transaction
+DB_BATCHTIME = 5    # Maximum seconds to keep cache writes uncommitted
+DB_INITSQL = ("CREATE TABLE IF NOT EXISTS files "
+              "(path TEXT NOT NULL PRIMARY KEY, size INTEGER, mtime REAL, "
+              "inode INTEGER, fingerprint BLOB, hash BLOB, "
+              "dt TIMESTAMP DEFAULT (STRFTIME('%Y-%m-%d %H:%M:%f', 'now')))")
 
 
-def find_duplicates(paths, wildcards=("*",), recursive=False, sizeonly=False):
-    """Yields duplicate files as (size, [files])."""
-    files = find_files(paths, wildcards, recursive)
-    sizes = collections.defaultdict(list)
-    for f, size in ((f, pathhandler(os.path.getsize)(f)) for f in files):
-        sizes[size].append(f)
-    for size, ff in sizes.items():
-        if len(ff) < 2: sizes.pop(size)
+def find_duplicates(paths, wildcards=("*",), recursive=False, sizeonly=False,
+                    prefilter=True, cache=None, maxopen=None, maxblock=8388608,
+                    jobs=1, engine="read", dirs=False, linked=None,
+                    index=None, stats=None):
+    """
+    Yields duplicate files as (size, [files]). Hardlinks to the same file
+    are compared only once, as the first path encountered.
+
+    @param   prefilter  whether to split size groups by sampled fingerprints
+                        before full comparison
+    @param   cache      path to SQLite database for caching fingerprints and
+                        content hashes, if any; files get compared by hash
+    @param   maxopen    maximum number of files to keep open in comparison,
+                        per job
+    @param   maxblock   maximum number of bytes to read from a file at once
+    @param   jobs       number of size groups to compare concurrently,
+                        results still yielded in descending size order
+    @param   engine     comparison engine, "read" for block streams or "mmap"
+                        for memory-mapped files
+    @param   dirs       whether to report duplicate directories as a whole,
+                        as (size, [directories ending with path separator]),
+                        yielding results only after all comparison
+    @param   linked     list to append hardlinked files to as (size, [files])
+                        before any comparison, if any
+    @param   index      dictionary to populate with all scanned files as
+                        {size: [[file paths of identical content], ]}, if any
+                        and not sizeonly
+    @param   stats      dictionary to update with byte counts, if any,
+                        and file count and phase durations as
+                        {"files", "walktime", "stattime", "grouptime"}
+    """
+    index = None if sizeonly else index # Size groups are not identical content
+    files = PathIndex(stat=bool(cache and not sizeonly)) # For cache rows
+    relpath = lambda x: get_relpath(x, paths)
+    clock, stattime = time.time(), 0
+    for folder, name in walk_files(paths, wildcards, recursive):
+        statclock = time.time()
+        try: st = pathhandler(os.stat)(os.path.join(folder, name))
+        except EnvironmentError: st = None
+        stattime += time.time() - statclock
+        if not st or not stat.S_ISREG(st.st_mode): continue # for folder, name
+        haslinks = st.st_nlink > 1 and st.st_ino # Inode 0 if not supported
+        files.add(folder, name, st.st_size, st.st_mtime, st.st_ino,
+                  st.st_dev if haslinks else None)
+    files.resolve_links()
+    if stats is not None:
+        stats.update(files=len(files), stattime=stattime,
+                     walktime=time.time() - clock - stattime)
+    linksets = collections.OrderedDict() # {index of first path: [index, ]}
+    for i, link in enumerate(files.links if dirs or linked is not None else ()):
+        if link >= 0: linksets.setdefault(link, [link]).append(i)
+    links = [map(files.path, ii) for ii in linksets.values()] if dirs else []
+    if linked is not None:
+        linked.extend((int(files.sizes[ii[0]]), sorted((relpath(files.path(i))
+                       for i in ii), key=lambda x: x.lower()))
+                      for ii in linksets.values())
+
+    clock = time.time()
+    sizegroups = files.get_sizegroups()
+    if stats is not None: stats["grouptime"] = time.time() - clock
+
+    def get_groups():
+        """Yields (size, [paths]) for sizes shared by more than one file."""
+        for size, ii in sizegroups:
+            if len(ii) > 1:
+                ff = map(files.path, ii)
+                for i, f in zip(ii, ff) if cache else ():
+                    cache.load(f, size, files.mtimes[i], int(files.inodes[i]))
+                yield (size, ff)
+            elif index is not None: index[size] = [[files.path(ii[0])]]
+
+    cache = HashCache(cache, stats) if cache and not sizeonly else None
+    groups = get_groups()
+    compare = lambda size, ff: (size, [ff], {}) if sizeonly else \
+              (size, ) + compare_sizegroup(size, ff, prefilter, cache,
+                                           maxopen, maxblock, engine)
+    results, dupesets = imap_ordered(compare, groups, jobs), []
+    try:
+        for size, filesets, groupstats in results:
+            for k, v in groupstats.items() if stats is not None else ():
+                stats[k] = stats.get(k, 0) + v
+            if index is not None: index[size] = filesets
+            for dupes in (x for x in filesets if len(x) > 1):
+                if dirs: dupesets.append((size, dupes))
+                else: yield (size, sorted(map(relpath, dupes),
+                                          key=lambda x: x.lower()))
+        for size, dupes in rollup_dirs(paths, files.iteritems(), dupesets,
+                                       links) if dirs else ():
+            yield (size, sorted(map(relpath, dupes), key=lambda x: x.lower()))
+        if cache:
+            cache.prune(paths, recursive, files.get_sortedpaths())
+    finally:
+        results.close()
+        if cache: cache.close()
+
 
-    for size, sizefiles in sorted(sizes.items(), key=lambda (s, ff): -s):
-        filesets = [sizefiles] if sizeonly else compare_files(sizefiles)
-        for dupes in (x for x in filesets if len(x) > 1):
-            dupes = sorted(dupes, key=lambda x: x.lower())
-            if len(paths) == 1:
-                dupes = [x.replace(paths[0], "").lstrip("\\/") for x in dupes]
-            yield (size, dupes)
+def watch_duplicates(paths, wildcards=("*",), recursive=False, index=None,
+                     maxopen=None, maxblock=8388608):
+    """
+    Yields new duplicate files as (size, [files]) as files get written or
+    moved under paths, comparing each changed file against the files
+    of the same size. Uses inotify, Linux only.
+
+    @param   index      {size: [[file paths of identical content], ]} of files
+                        already scanned, as populated by find_duplicates(),
+                        updated in place
+    """
+    paths = [paths] if isinstance(paths, basestring) else paths
+    wildcards = [wildcards] if isinstance(wildcards, basestring) else wildcards
+    match = re.compile("|".join(map(fnmatch.translate, wildcards)), re.I).match
+    if not wildcards: match = lambda x: True
+    index = {} if index is None else index
+    sizeof = dict((p, s) for s, xx in index.items() for ff in xx for p in ff)
+    MASK = Inotify.IN_CLOSE_WRITE | Inotify.IN_CREATE | Inotify.IN_DELETE | \
+           Inotify.IN_MOVED_FROM | Inotify.IN_MOVED_TO
+
+    def watch(path):
+        """Adds watches for directory and its subdirectories if recursive."""
+        for root, dirs, files in os.walk(path):
+            inotify.add(root, MASK)
+            if not recursive: break # for root, dirs, files
+
+    def remove(path):
+        """Drops file from index."""
+        if path not in sizeof: return
+        size = sizeof.pop(path)
+        for ff in index.get(size, []):
+            if path in ff: ff.remove(path)
+        index[size] = [ff for ff in index.get(size, []) if ff]
+        if not index[size]: index.pop(size)
+
+    def add(path):
+        """Adds file to index, returns (size, [files]) if duplicated."""
+        remove(path)
+        try: size = pathhandler(os.path.getsize)(path)
+        except EnvironmentError: return # File already gone
+        sets = index.setdefault(size, [])
+        try: groups = compare_files([path] + [ff[0] for ff in sets],
+                                    maxopen, maxblock)
+        except EnvironmentError: groups = [] # Something got deleted meanwhile
+        group = next((ff for ff in groups if path in ff and len(ff) > 1), None)
+        fileset = next((ff for ff in sets if group and ff[0] in group), None)
+        if fileset is None: sets.append([path])
+        else: fileset.append(path)
+        sizeof[path] = size
+        if fileset: return (size, sorted(map(lambda x: get_relpath(x, paths),
+                                             fileset), key=lambda x: x.lower()))
+
+    inotify = Inotify()
+    try:
+        for path in paths: watch(unicode(os.path.abspath(path)))
+        while True:
+            for mask, path in inotify.read():
+                if mask & Inotify.IN_ISDIR:
+                    if mask & (Inotify.IN_DELETE | Inotify.IN_MOVED_FROM):
+                        prefix = path + os.sep
+                        for f in [x for x in sizeof if x.startswith(prefix)]:
+                            remove(f)
+                    if not recursive or not mask & (Inotify.IN_CREATE |
+                                                    Inotify.IN_MOVED_TO):
+                        continue # for mask, path
+                    watch(path)
+                    for f in find_files(path, wildcards, recursive):
+                        result = add(f)
+                        if result: yield result
+                elif mask & (Inotify.IN_DELETE | Inotify.IN_MOVED_FROM):
+                    remove(path)
+                elif mask & (Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO) \
+                and match(os.path.basename(path)):
+                    result = add(path)
+                    if result: yield result
+    finally:
+        inotify.close()
+
+
+def write_manifest(filename, paths, wildcards=("*",), recursive=False,
+                   cache=None, hashes=True):
+    """
+    Writes a manifest of files under paths, as gzipped JSON lines: first
+    {"host", "paths", "created"}, then [path, size, mtime, fingerprint, hash]
+    for each file, digests in hex or null. Files larger than sampling span
+    get a sampled fingerprint, and all files a full hash. Hardlinks to
+    the same file are read only once.
+
+    @param   cache      path to SQLite database for caching fingerprints and
+                        content hashes, if any
+    @param   hashes     whether to hash files larger than sampling span,
+                        else their full hashes are included only if
+                        available from cache, and merge_manifests()
+                        can verify them only on local host
+    @return             number of files written
+    """
+    paths = [paths] if isinstance(paths, basestring) else paths
+    cache, count = HashCache(cache) if cache else None, 0
+    hexify = lambda x: x and binascii.hexlify(x)
+    inodes = {} # {(device, inode): (fingerprint, hash)} of hardlinked files
+    try:
+        with gzip.open(filename, "wb") as f:
+            f.write(json.dumps({"host": socket.gethostname(), "created":
+                                time.strftime("%Y-%m-%d %H:%M:%S"), "paths":
+                                map(os.path.abspath, paths)}) + "\n")
+            for folder, name in walk_files(paths, wildcards, recursive):
+                path = os.path.join(folder, name)
+                try: st = pathhandler(os.stat)(path)
+                except EnvironmentError: continue # for folder, name
+                if not stat.S_ISREG(st.st_mode): continue # for folder, name
+                inode = (st.st_dev, st.st_ino) if st.st_nlink > 1 \
+                        and st.st_ino else None # Inode is 0 if not supported
+                fingerprint, digest = inodes.get(inode, (None, None))
+                if cache and inode not in inodes:
+                    cache.load(path, st.st_size, st.st_mtime, st.st_ino)
+                    fingerprint = cache.get(path, "fingerprint")
+                    digest = cache.get(path, "hash")
+                if st.st_size > SAMPLE_MINSIZE and fingerprint is None:
+                    fingerprint = get_fingerprint(path, st.st_size)
+                    if cache: cache.set(path, fingerprint=fingerprint)
+                if digest is None and (hashes or st.st_size <= SAMPLE_MINSIZE):
+                    digest = get_hash(path)
+                    if cache: cache.set(path, hash=digest)
+                if cache: cache.release([path])
+                if inode: inodes[inode] = (fingerprint, digest)
+                item = [path, st.st_size, st.st_mtime, hexify(fingerprint),
+                        hexify(digest)]
+                f.write(json.dumps(item) + "\n")
+                count += 1
+    finally:
+        if cache: cache.close()
+    return count
+
+
+def merge_manifests(filenames, unverified=None):
+    """
+    Yields duplicate files across manifests as (size, ["host:path", ]),
+    matching by size, fingerprint and full hash. Files lacking a full hash
+    get hashed if local and unchanged since manifest. Files listed in several
+    manifests from the same host are taken once, with latest modification.
+
+    @param   filenames   manifest files as written by write_manifest()
+    @param   unverified  list to append (size, ["host:path", ]) to, if any,
+                         for files matching by fingerprint where full hash
+                         was not available, together with the first file
+                         of each full hash they probably match
+    """
+    entries = {} # {(host, path): [size, mtime, fingerprint, hash]}
+    host = socket.gethostname()
+    for filename in filenames:
+        with gzip.open(filename, "rb") as f:
+            header = json.loads(f.readline())
+            for line in f:
+                path, size, mtime, fingerprint, digest = json.loads(line)
+                key = (header["host"], path)
+                if key in entries and entries[key][1] >= mtime:
+                    continue # for line, overlapping or older manifest
+                entries[key] = [size, mtime, fingerprint, digest]
+    sizes = collections.defaultdict(list) # {size: [[host, path, mtime, ..]]}
+    while entries:
+        (host_, path), (size, mtime, fingerprint, digest) = entries.popitem()
+        sizes[size].append([host_, path, mtime, fingerprint, digest])
+
+    def get_local_hash(item):
+        """Returns hex hash of local file, if still unchanged, else None."""
+        host_, path, mtime = item[:3]
+        if host_ != host: return None
+        try: st = pathhandler(os.stat)(path)
+        except EnvironmentError: return None
+        if st.st_mtime != mtime: return None
+        return binascii.hexlify(get_hash(path))
+
+    for size in sorted((x for x in sizes if len(sizes[x]) > 1), reverse=True):
+        fingerprints = collections.defaultdict(list) # {fingerprint: [item, ]}
+        for item in sizes.pop(size): fingerprints[item[3]].append(item)
+        for items in (x for x in fingerprints.values() if len(x) > 1):
+            for item in items:
+                if not item[4]: item[4] = get_local_hash(item)
+            labels = lambda xx: sorted("%s:%s" % tuple(x[:2]) for x in xx)
+            hashes = collections.defaultdict(list) # {hash: [item, ]}
+            for item in items: hashes[item[4]].append(item)
+            unhashed = hashes.pop(None, [])
+            if unhashed and unverified is not None:
+                unverified.append((size, labels(unhashed +
+                                   [x[0] for x in hashes.values()])))
+            for dupes in (x for x in hashes.values() if len(x) > 1):
+                yield (size, labels(dupes))
+
+
+def compare_sizegroup(size, filepaths, prefilter=True, cache=None,
+                      maxopen=None, maxblock=8388608, engine="read"):
+    """
+    Checks which of the specified files of the same size have the same content.
+
+    @param   prefilter  whether to split files by sampled fingerprints first
+    @param   cache      HashCache to use, if any; files get compared by hash
+    @param   maxopen    maximum number of files to keep open in comparison
+    @param   maxblock   maximum number of bytes to read from a file at once
+    @param   engine     comparison engine, "read" or "mmap"
+    @return             ([[file paths of identical content], ],
+                         {"sampled": bytes, "prefiltered": bytes, ..})
+    """
+    stats, filesets = {}, [filepaths]
+    if prefilter: filesets = prefilter_files(filepaths, size, stats, cache)
+    comparer = compare_files_mmap if "mmap" == engine else compare_files
+    compare = (lambda ff: hash_files(ff, cache, stats, size)) if cache \
+              else (lambda ff: comparer(ff, maxopen, maxblock))
+    filesets = [x for ff in filesets for x in compare(ff)]
+    if cache: cache.release(filepaths)
+    return filesets, stats
+
+
+def imap_ordered(func, iterable, jobs=1):
+    """
+    Yields func(*args) for each args in iterable, in iterable order.
+    With more than one job, calls run concurrently in a thread pool,
+    with up to twice as many results in flight as there are jobs.
+    """
+    if jobs < 2:
+        for args in iterable: yield func(*args)
+        return
+    pool, pending = multiprocessing.pool.ThreadPool(jobs), collections.deque()
+    try:
+        for args in iterable:
+            pending.append(pool.apply_async(func, args))
+            if len(pending) >= 2 * jobs:
+                yield pending.popleft().get(sys.maxint) # Timeout for Ctrl-C
+        while pending: yield pending.popleft().get(sys.maxint)
+    finally:
+        pool.terminate()
+
+
+def rollup_dirs(paths, files, dupesets, links=()):
+    """
+    Returns duplicate directories, and duplicate files not already implied
+    by duplicate parent directories, using directory digests rolled up
+    bottom-up from file content groups and subdirectory digests.
+    No file content is read: files get labelled by the group they are in.
+
+    @param   paths      root directories scanned
+    @param   files      iterable of (path, size) for all files scanned
+    @param   dupesets   [(size, [file paths of identical content]), ]
+    @param   links      [[hardlinked file paths], ], first linked path
+                        being the one compared
+    @return             [(size, [paths of identical content]), ] by
+                        descending size, directory paths ending with separator
+    """
+    roots = set(os.path.normpath(unicode(os.path.abspath(x))) for x in paths)
+    labels = dict((p, i) for i, (s, ff) in enumerate(dupesets) for p in ff)
+    for ff in links: labels.update((p, labels.get(ff[0], ff[0])) for p in ff)
+    entries = collections.defaultdict(list) # {dir: [(name, label), ]}
+    subdirs = collections.defaultdict(set)  # {dir: set(subdir, )}
+    dirsizes = collections.defaultdict(int) # {dir: size of all files under}
+    for path, size in files:
+        folder, name = os.path.split(path)
+        entries[folder].append((name, labels.get(path, path)))
+        while True:
+            dirsizes[folder] += size
+            parent = os.path.dirname(folder)
+            if folder in roots or parent == folder: break # while True
+            subdirs[parent].add(folder)
+            folder = parent
+
+    digests, bydigest = {}, collections.defaultdict(list) # {dir: digest}, ..
+    for folder in sorted(dirsizes, key=lambda x: -x.count(os.sep)):
+        items = sorted(entries[folder]) + sorted(
+            (os.path.basename(x) + os.sep, digests[x]) for x in subdirs[folder])
+        digests[folder] = hashlib.sha1(repr(items)).digest()
+        bydigest[digests[folder]].append(folder)
+    for ff in bydigest.values(): ff.sort() # First copy kept for its contents
+
+    def unimplied(ff):
+        """
+        Returns items not in duplicate parent directories, plus items in
+        the first of each set of duplicate parent directories, as items
+        under the other copies are implied by the copies themselves.
+        """
+        result = []
+        for x in ff:
+            parent = os.path.dirname(x.rstrip(os.sep))
+            copies = bydigest.get(digests.get(parent), [])
+            if len(copies) < 2 or parent == copies[0]: result.append(x)
+        return result
+    result = [(dirsizes[ff[0]], [x + os.sep for x in ff])
+              for ff in bydigest.values() if len(ff) > 1]
+    result += dupesets
+    result = [(size, unimplied(ff)) for size, ff in result]
+    result = [(size, ff) for size, ff in result if len(ff) > 1]
+    return sorted(result, key=lambda (s, ff): (-s, not ff[0].endswith(os.sep)))
 
 
 def find_files(paths=(".",), wildcards=("*",), recursive=True):
     """Returns a list of full filepaths matching wildcards under paths."""
+    files = (os.path.join(root, x)
+             for root, x in walk_files(paths, wildcards, recursive))
+    return filter(pathhandler(os.path.isfile), files)
+
+
+def walk_files(paths=(".",), wildcards=("*",), recursive=True):
+    """Yields (directory, filename) for names matching wildcards under paths."""
     paths = [paths] if isinstance(paths, basestring) else paths
     wildcards = [wildcards] if isinstance(wildcards, basestring) else wildcards
-    result = []
     match = re.compile("|".join(map(fnmatch.translate, wildcards)), re.I).match
     if not wildcards: match = lambda x: True
     for path in paths:
         for root, dirs, files in os.walk(unicode(os.path.abspath(path))):
-            files = [os.path.join(root, x) for x in files if match(x)]
-            files = map(os.path.normpath, files)
-            result.extend(filter(pathhandler(os.path.isfile), files))
+            root = os.path.normpath(root)
+            for x in files:
+                if match(x): yield root, x
             if not recursive: break # for root, dirs, files
+
+
+def prefilter_files(filepaths, size, stats=None, cache=None):
+    """
+    Splits files of the same size into groups by sampled content fingerprint,
+    skipping files too small for sampling to be cheaper than comparison.
+
+    @param   filepaths  a list of file paths of identical size
+    @param   size       size of the files
+    @param   stats      dictionary to update with "sampled" bytes read and
+                        "prefiltered" bytes excluded from full comparison
+    @param   cache      HashCache to take unchanged fingerprints from, if any
+    @return             [[file paths of identical fingerprint], ]
+    """
+    if len(filepaths) < 2 or size <= SAMPLE_MINSIZE:
+        return [filepaths]
+    groups = collections.defaultdict(list) # {fingerprint: [path, ]}
+    samplesize, sampled = len(get_sample_offsets(size)) * SAMPLE_SIZE, 0
+    for f in filepaths:
+        fingerprint = cache.get(f, "fingerprint") if cache else None
+        if fingerprint is None:
+            fingerprint = get_fingerprint(f, size)
+            sampled += samplesize
+            if cache: cache.set(f, fingerprint=fingerprint)
+        groups[fingerprint].append(f)
+    if stats is not None:
+        excluded = sum(size for ff in groups.values() if len(ff) < 2)
+        stats["sampled"] = stats.get("sampled", 0) + sampled
+        stats["prefiltered"] = stats.get("prefiltered", 0) + excluded
+    return groups.values()
+
+
+def get_fingerprint(filepath, size):
+    """Returns digest of content samples from head, tail and spread offsets."""
+    result = hashlib.sha1()
+    with pathhandler(open)(filepath, "rb") as f:
+        for offset in get_sample_offsets(size):
+            f.seek(offset)
+            result.update(f.read(SAMPLE_SIZE))
+    return result.digest()
+
+
+def get_sample_offsets(size):
+    """Returns a list of file offsets to read fingerprint samples from."""
+    step = max(0, size - SAMPLE_SIZE) / float(SAMPLE_COUNT - 1)
+    return sorted(set(int(i * step) for i in range(SAMPLE_COUNT)))
+
+
+def hash_files(filepaths, cache=None, stats=None, size=None):
+    """
+    Checks which of the specified files have the same content hash.
+
+    @param   filepaths  a list of file paths to process
+    @param   cache      HashCache to take unchanged hashes from and store
+                        calculated hashes to, if any
+    @param   stats      dictionary to update with "hashed" bytes read, if any
+    @param   size       size of the files if all of the same size, if known
+    @return             [[file paths of identical content], ]
+    """
+    if len(filepaths) < 2: return [filepaths]
+    groups = collections.defaultdict(list) # {hash: [path, ]}
+    for f in filepaths:
+        digest = cache.get(f, "hash") if cache else None
+        if digest is None:
+            digest = get_hash(f)
+            if cache: cache.set(f, hash=digest)
+            if stats is not None:
+                stats["hashed"] = stats.get("hashed", 0) + (size if size
+                                  is not None else
+                                  pathhandler(os.path.getsize)(f))
+        groups[digest].append(f)
+    return groups.values()
+
+
+def get_hash(filepath, BLOCKSIZE=81920):
+    """Returns the SHA-1 digest of file content."""
+    result = hashlib.sha1()
+    with pathhandler(open)(filepath, "rb") as f:
+        for block in iter(lambda: f.read(BLOCKSIZE), ""): result.update(block)
+    return result.digest()
+
+
+def compare_files(filepaths, maxopen=None, maxblock=8388608, BLOCKSIZE=81920,
+                  BRANCHBUFFER=67108864):
+    """
+    Checks which of the specified files have the same content. Read size
+    doubles while a branch keeps matching, up to maxblock and up to
+    BRANCHBUFFER bytes in total for the branch.
+
+    @param   filepaths  a list of file paths to process
+    @param   maxopen    maximum number of files to keep open at once, if any
+    @param   maxblock   maximum number of bytes to read from a file at once
+    @return             [[file paths of identical content], ]
+    """
+    if len(filepaths) < 2: return [filepaths]
+    maxblock = max(1, maxblock)
+    size = min(BLOCKSIZE, maxblock)
+    result, branches = [], [(list(filepaths), size)] # [([path, ], size)]
+    streams, buffers = FilePool(maxopen), {} # {path: bytearray}
+    # Files get divided into separate branches as content starts to differ.
+    while branches:
+        paths, size = branches.pop()
+        blocks, done = [], []
+        for p in paths:
+            if len(buffers.get(p, "")) < size: buffers[p] = bytearray(size)
+            view = memoryview(buffers[p])[:size]
+            blocks.append(view[:streams.readinto(p, view)])
+        if all(x == blocks[0] for x in blocks[1:]):
+            if not len(blocks[0]): done.append(paths)
+            else:
+                limit = max(BLOCKSIZE, BRANCHBUFFER / len(paths))
+                branches.append((paths, min(2 * size, limit, maxblock)))
+        elif len(paths) == 2: done.extend([p] for p in paths)
+        else:
+            pathmap = collections.defaultdict(list) # {block: [path, ]}
+            for p, block in zip(paths, blocks):
+                pathmap[block.tobytes()].append(p)
+            for block, ff in pathmap.items():
+                if block and len(ff) > 1: branches.append((ff, size))
+                else: done.append(ff)
+        for p in (p for ff in done for p in ff):
+            streams.close(p), buffers.pop(p)
+        result.extend(done)
+    streams.close()
     return result
 
 
-def compare_files(filepaths, BLOCKSIZE=81920):
+def compare_files_mmap(filepaths, maxopen=None, maxblock=8388608,
+                       BLOCKSIZE=81920):
     """
-    Checks which of the specified files have the same content.
+    Checks which of the specified files have the same content, comparing
+    memory-mapped files in place, in a window growing while content matches.
+    Falls back to compare_files() if files cannot be mapped, or if there are
+    more files than allowed to keep open.
 
     @param   filepaths  a list of file paths to process
+    @param   maxopen    maximum number of files to keep open at once, if any
+    @param   maxblock   maximum number of bytes to compare at once
     @return             [[file paths of identical content], ]
     """
     if len(filepaths) < 2: return [filepaths]
+    if maxopen and len(filepaths) > maxopen:
+        return compare_files(filepaths, maxopen, maxblock, BLOCKSIZE)
+    maps = {} # {path: mmap}
+    try:
+        for p in filepaths:
+            with pathhandler(open)(p, "rb") as f:
+                maps[p] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (EnvironmentError, ValueError): # Empty files cannot be mapped
+        for m in maps.values(): m.close()
+        return compare_files(filepaths, maxopen, maxblock, BLOCKSIZE)
+
     result, branches = [], [list(filepaths)]
-    streams = dict((p, pathhandler(open)(p, "rb")) for p in filepaths)
+    maxblock = max(1, maxblock)
+    offset, size = 0, min(BLOCKSIZE, maxblock)
+    end = max(len(m) for m in maps.values())
     # Files get divided into separate branches as content starts to differ.
-    while branches:
+    while branches and offset < end:
         for paths in list(branches):
-            blocks, pathmap = [streams[p].read(BLOCKSIZE) for p in paths], {}
-            for i, block in enumerate(blocks):
-                pathmap[block] = pathmap.get(block, []) + [paths[i]]
-            for block, count in collections.Counter(blocks).items():
-                if not block or count != len(blocks):
-                    for p in pathmap[block]: paths.remove(p)
-                    target = branches if block and count > 1 else result
-                    target.append(pathmap[block])
-            if not paths: branches.remove(paths)
-    for f in streams.values(): f.close()
-    return result
+            first = buffer(maps[paths[0]], offset, size) # Zero-copy slice
+            if all(buffer(maps[p], offset, size) == first for p in paths[1:]):
+                continue # for paths
+            branches.remove(paths)
+            if len(paths) == 2:
+                result.extend([p] for p in paths)
+                continue # for paths
+            pathmap = collections.defaultdict(list) # {block: [path, ]}
+            for p in paths: pathmap[buffer(maps[p], offset, size)].append(p)
+            for ff in pathmap.values():
+                (branches if len(ff) > 1 else result).append(ff)
+        offset, size = offset + size, min(2 * size, maxblock)
+    for m in maps.values(): m.close()
+    return result + branches
+
+
+class PathIndex(object):
+    """
+    Compact columnar index of file paths and sizes: directories are stored
+    once, file names as offsets into a shared UTF-8 buffer, and numbers
+    in typed arrays. Full paths get built only on request.
+    """
+
+    try: INT64 = array.array("q").typecode # Py3
+    except ValueError: # Py2 has no "q", and C long is 32-bit on Windows
+        INT64 = "l" if array.array("l").itemsize >= 8 else "d"
+    try: UINT64 = array.array("Q").typecode # Py3
+    except ValueError: UINT64 = "L" if array.array("L").itemsize >= 8 else "d"
+
+    def __init__(self, stat=False):
+        """
+        @param   stat  whether to also keep file modification times and inodes
+        """
+        self.dirs    = []                # [directory path, ]
+        self.dirids  = {}                # {directory path: index in dirs}
+        self.folders = array.array("l")  # [index in dirs, ] per file
+        self.names   = bytearray()       # All file names in UTF-8
+        self.offsets = array.array(self.INT64) # [name end offset in names, ]
+        self.sizes   = array.array(self.INT64) # [file size, ]
+        self.links   = array.array("l")  # [index of earlier hardlink or -1, ]
+        self.mtimes  = array.array("d") if stat else None # [mtime, ]
+        self.inodes  = array.array(self.UINT64) if stat else None # [inode, ]
+        self.linked  = array.array("l")  # [index of file having links, ]
+        self.linkdevs = array.array(self.UINT64) # [device, ] per linked file
+        self.linkinos = array.array(self.UINT64) # [inode, ] per linked file
+
+
+    def __len__(self):
+        return len(self.sizes)
+
+
+    def add(self, folder, name, size, mtime=0, inode=0, device=None):
+        """
+        Adds file to index, modification time and inode retained if index
+        keeps stat data. Device is given for files having several links,
+        to find hardlinks by device and inode in resolve_links().
+        """
+        if folder not in self.dirids:
+            self.dirids[folder] = len(self.dirs)
+            self.dirs.append(folder)
+        self.folders.append(self.dirids[folder])
+        self.names.extend(name.encode("utf-8"))
+        self.offsets.append(len(self.names))
+        self.sizes.append(size)
+        self.links.append(-1)
+        if self.mtimes is not None:
+            self.mtimes.append(mtime)
+            self.inodes.append(inode)
+        if device is not None:
+            self.linked.append(len(self.sizes) - 1)
+            self.linkdevs.append(device)
+            self.linkinos.append(inode)
+
+
+    def resolve_links(self, CHUNK=262144):
+        """
+        Sets links of files added with device to index of the first file
+        of the same device and inode, clearing device and inode data.
+        Sorting is done in chunks kept as compact arrays, merged after.
+        """
+        chunks, ids = [], iter(xrange(len(self.linked)))
+        key = lambda j: (self.linkdevs[j], self.linkinos[j], self.linked[j])
+        for chunk in iter(lambda: sorted(itertools.islice(ids, CHUNK),
+                                         key=key), []):
+            chunks.append(array.array("l", chunk))
+        order = heapq.merge(*[(key(j) for j in x) for x in chunks])
+        for _, ii in itertools.groupby(order, lambda x: x[:2]):
+            first = next(ii)[2]
+            for _, _, i in ii: self.links[i] = first
+        for x in self.linked, self.linkdevs, self.linkinos: del x[:]
+
+
+    def path(self, i):
+        """Returns full path of file at index."""
+        start = int(self.offsets[i - 1]) if i else 0
+        name = str(self.names[start:int(self.offsets[i])]).decode("utf-8")
+        return os.path.join(self.dirs[self.folders[i]], name)
+
+
+    def iteritems(self):
+        """Yields (path, size) for all files."""
+        for i in xrange(len(self.sizes)): yield self.path(i), int(self.sizes[i])
+
+
+    def get_sortedpaths(self, CHUNK=262144):
+        """
+        Returns an iterator yielding full paths of all files UTF-8 encoded,
+        in sorted order. Sorting is done before returning, in chunks kept
+        as compact arrays, merged while iterating.
+        """
+        chunks, key = [], lambda i: self.path(i).encode("utf-8")
+        indexes = iter(xrange(len(self.sizes)))
+        for chunk in iter(lambda: sorted(itertools.islice(indexes, CHUNK),
+                                         key=key), []):
+            chunks.append(array.array("l", chunk))
+        return heapq.merge(*[(key(i) for i in x) for x in chunks])
+
+
+    def get_sizegroups(self, CHUNK=262144):
+        """
+        Returns an iterator yielding (size, [file indexes]) for all sizes
+        in descending order, with files in adding order, skipping later
+        hardlinks to a file. Sorting is done before returning, in chunks
+        kept as compact arrays, merged while iterating.
+        """
+        chunks, size = [], self.sizes.__getitem__
+        indexes = (i for i, x in enumerate(self.links) if x < 0)
+        for chunk in iter(lambda: sorted(itertools.islice(indexes, CHUNK),
+                                         key=size, reverse=True), []):
+            chunks.append(array.array("l", chunk))
+        order = heapq.merge(*[((-size(i), i) for i in x) for x in chunks])
+        return ((int(-k), [i for _, i in ii]) for k, ii
+                in itertools.groupby(order, lambda x: x[0]))
+
+
+
+class FilePool(object):
+    """
+    Reads files by path, keeping at most a given number of them open:
+    least recently read files get closed and later reopened at last offset.
+    """
+
+    def __init__(self, maxopen=None):
+        self._maxopen = maxopen
+        self._files   = collections.OrderedDict() # {path: file}, by last use
+        self._offsets = {} # {path: offset to resume reading from}
+
+
+    def readinto(self, path, buffer):
+        """Reads next block from file into buffer, returns bytes read."""
+        f = self._files.pop(path, None)
+        if not f:
+            if self._maxopen and len(self._files) >= self._maxopen:
+                self.release(next(iter(self._files)))
+            f = pathhandler(open)(path, "rb")
+            f.seek(self._offsets.pop(path, 0))
+            fadvise(f, POSIX_FADV_SEQUENTIAL)
+        self._files[path] = f
+        return f.readinto(buffer)
+
+
+    def release(self, path):
+        """Closes the file, retaining its offset for reopening."""
+        f = self._files.pop(path, None)
+        if f: self._offsets[path] = f.tell(); f.close()
+
+
+    def close(self, path=None):
+        """Closes the specified file, or all files if path not given."""
+        for p in [path] if path else list(self._files):
+            f = self._files.pop(p, None)
+            if f: f.close()
+            self._offsets.pop(p, None)
+        if not path: self._offsets.clear()
+
+
+
+class HashCache(object):
+    """
+    SQLite cache of file fingerprints and content hashes, stored values
+    remaining valid while file size, modification time and inode are unchanged.
+    """
+
+    def __init__(self, dbpath, stats=None, batchsize=DB_BATCHSIZE,
+                 batchtime=DB_BATCHTIME):
+        """
+        Opens the database, creating it if necessary.
+
+        @param   batchsize  number of writes to commit in one transaction
+        @param   batchtime  maximum seconds to keep writes uncommitted
+        """
+        self._db = sqlite3.connect(dbpath, check_same_thread=False)
+        for sql in DB_PRAGMAS: self._db.execute(sql)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute(DB_INITSQL)
+        self._rows = {} # {path: {size, mtime, inode, fingerprint, hash}}
+        self._stats = stats if stats is not None else {}
+        self._lock = threading.RLock() # Cache is shared by comparison jobs
+        self._batchsize, self._batchtime = batchsize, batchtime
+        self._batch = {"count": 0, "start": None} # Uncommitted writes
+
+
+    def load(self, filepath, size, mtime, inode):
+        """Loads cached row for file with given stat data, sparing a stat."""
+        with self._lock:
+            if filepath not in self._rows:
+                self._load(filepath, (size, mtime, inode))
+
+
+    def get(self, filepath, key):
+        """Returns cached "fingerprint" or "hash", or None if file changed."""
+        with self._lock:
+            result = self._load(filepath)[key]
+            if result is not None:
+                self._stats["cachehits"] = self._stats.get("cachehits", 0) + 1
+        return result
+
+
+    def set(self, filepath, **values):
+        """Stores fingerprint and/or hash for file with current stat data."""
+        with self._lock:
+            row = self._load(filepath)
+            row.update(values)
+            self._db.execute("INSERT OR REPLACE INTO files (path, size, mtime, "
+                             "inode, fingerprint, hash) VALUES (:path, :size, "
+                             ":mtime, :inode, :fingerprint, :hash)", dict(row,
+                             **dict((k, sqlite3.Binary(row[k]))
+                                    for k in ("fingerprint", "hash")
+                                    if row[k])))
+            if not self._batch["count"]: self._batch["start"] = time.time()
+            self._batch["count"] += 1
+
+
+    def release(self, filepaths):
+        """
+        Clears loaded rows of given files, committing pending changes
+        if batch is full or open longer than batch time.
+        """
+        with self._lock:
+            for f in filepaths: self._rows.pop(f, None)
+            count, start = self._batch["count"], self._batch["start"]
+            if count >= self._batchsize \
+            or count and time.time() - start >= self._batchtime:
+                self._db.commit()
+                self._batch["count"] = 0
+
+
+    def commit(self, filepaths=None):
+        """Commits pending changes, clears loaded rows of given or all files."""
+        with self._lock:
+            self._db.commit()
+            self._batch["count"] = 0
+            for f in filepaths or []: self._rows.pop(f, None)
+            if filepaths is None: self._rows.clear()
+
+
+    def prune(self, paths, recursive, filepaths):
+        """
+        Deletes entries of files under paths that no longer exist, in bulk.
+        Entries are merged in path order against scanned files, checking
+        existence only for entries not scanned.
+
+        @param   filepaths  iterable of all file paths encountered in scanning
+                            paths, UTF-8 encoded and in sorted order
+        """
+        self.commit()
+        gone, filepaths = [], iter(filepaths)
+        roots = [os.path.normpath(unicode(os.path.abspath(x))) for x in paths]
+        scanned = next(filepaths, None)
+        for x in self._db.execute("SELECT path FROM files ORDER BY path"):
+            path = x["path"].encode("utf-8") # SQLite orders text by UTF-8
+            while scanned is not None and scanned < path:
+                scanned = next(filepaths, None)
+            if scanned == path: continue # for x
+            folder = os.path.dirname(x["path"])
+            if not any(folder == r or recursive and
+                       folder.startswith(r.rstrip(os.sep) + os.sep)
+                       for r in roots): continue # for x
+            if not pathhandler(os.path.exists)(x["path"]):
+                gone.append([x["path"]])
+        self._db.executemany("DELETE FROM files WHERE path = ?", gone)
+        self._db.commit()
+        self._stats["pruned"] = self._stats.get("pruned", 0) + len(gone)
+
+
+    def close(self):
+        """Commits pending changes and closes the database connection."""
+        with self._lock:
+            try: self._db.commit()
+            except Exception: pass
+            try: self._db.close()
+            except Exception: pass
+
+
+    def _load(self, filepath, st=None):
+        """
+        Returns cached row for file, with data cleared if file changed.
+
+        @param   st  (size, mtime, inode) of file if already known,
+                     else file gets stat-ed
+        """
+        if filepath not in self._rows:
+            if st is None:
+                stat = pathhandler(os.stat)(filepath)
+                st = stat.st_size, stat.st_mtime, stat.st_ino
+            row = {"path": filepath, "size": st[0], "mtime": st[1],
+                   "inode": st[2], "fingerprint": None, "hash": None}
+            for x in self._db.execute("SELECT * FROM files WHERE path = ?",
+                                      [filepath]):
+                if all(x[k] == row[k] for k in ("size", "mtime", "inode")):
+                    row.update((k, x[k] and str(x[k]))
+                               for k in ("fingerprint", "hash"))
+            self._rows[filepath] = row
+        return self._rows[filepath]
+
+
+
+class Inotify(object):
+    """Minimal ctypes wrapper for Linux inotify, watching directories."""
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM  = 0x00000040
+    IN_MOVED_TO    = 0x00000080
+    IN_CREATE      = 0x00000100
+    IN_DELETE      = 0x00000200
+    IN_IGNORED     = 0x00008000
+    IN_ISDIR       = 0x40000000
+    ENCODING = sys.getfilesystemencoding() or "utf-8"
+
+    def __init__(self):
+        """Creates inotify instance, raises OSError on failure."""
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = self._libc.inotify_init()
+        if self._fd < 0: raise OSError(ctypes.get_errno(), "inotify_init")
+        self._watches = {} # {watch descriptor: directory path}
+
+
+    def add(self, path, mask):
+        """Adds watch for directory events, raises OSError on failure."""
+        wd = self._libc.inotify_add_watch(self._fd, path.encode(self.ENCODING),
+                                          mask)
+        if wd < 0: raise OSError(ctypes.get_errno(), "inotify_add_watch", path)
+        self._watches[wd] = path
+
+
+    def read(self):
+        """Blocks until events are available, returns [(mask, path), ]."""
+        result, data, offset = [], os.read(self._fd, 65536), 0
+        while offset < len(data):
+            wd, mask, cookie, size = struct.unpack_from("iIII", data, offset)
+            name = data[offset + 16:offset + 16 + size].rstrip("\0")
+            offset += 16 + size
+            folder = self._watches.get(wd)
+            if mask & self.IN_IGNORED: self._watches.pop(wd, None)
+            if folder is None or not name: continue # while offset
+            name = name.decode(self.ENCODING, "replace")
+            result.append((mask, os.path.join(folder, name)))
+        return result
+
+
+    def close(self):
+        """Closes inotify instance, removing all watches."""
+        try: os.close(self._fd)
+        except Exception: pass
+
+
+
+def fadvise(f, advice):
+    """Gives the OS a hint on access pattern for the file, where supported."""
+    try: posix_fadvise(f.fileno(), 0, 0, advice)
+    except Exception: pass
+
+
+def get_relpath(path, paths):
+    """Returns path relative to scanned directory, if only one scanned."""
+    if len(paths) != 1: return path
+    return path.replace(paths[0], "").lstrip("\\/")
 
 
 def pathhandler(func):
@@ -132,18 +1089,80 @@ if "__main__" == __name__:
     for a in ARGUMENTS["arguments"]: parser.add_argument(*a.pop("args"), **a)
     args = parser.parse_args()
     for filetype in args.types or []: args.wildcards += TYPEGROUPS[filetype]
-    args.paths = args.dirs; del args.dirs; del args.types
+    args.paths, args.prefilter = args.directories, not args.noprefilter
+    del args.directories; del args.types; del args.noprefilter
+    watch, index = args.watch, {} if args.watch else None; del args.watch
+    if watch and not sys.platform.startswith("linux"):
+        parser.error("--watch is only supported on Linux")
+    if watch and args.sizeonly:
+        parser.error("--watch cannot be used with --sizeonly")
+    if args.maxblock < 1:
+        parser.error("--maxblock must be at least 1")
+    manifest, merge = args.manifest, args.merge
+    manifesthash = not args.nomanifesthash
+    del args.manifest; del args.merge; del args.nomanifesthash
 
     enc = sys.stdout.encoding or "utf-8"
     sys.stdout = codecs.getwriter(enc)(sys.stdout, errors="replace")
-    results = [] # [(size, files), ]
-    try:
-        for size, files in find_duplicates(**vars(args)):
+    if manifest:
+        count = write_manifest(manifest, args.paths, args.wildcards,
+                               args.recursive, args.cache, manifesthash)
+        print("Wrote %s files to manifest %s." % (count, manifest))
+        sys.exit()
+    if merge:
+        results, unverified = [], [] # [(size, files), ]
+        for size, files in merge_manifests(merge, unverified):
             if not results: print("\nDuplicate files:")
             results += [(size, files)]
             print("%s [%s]:\n  %s" % (format_bytes(size), len(files),
                   "\n  ".join(files)))
+        if unverified: print("\nProbable duplicates, lacking full hash:")
+        for size, files in unverified:
+            print("%s [%s]:\n  %s" % (format_bytes(size), len(files),
+                  "\n  ".join(files)))
+        print("\nDuplicates in total: %s, with %s of content." % (
+              sum(len(ff) for s, ff in results),
+              format_bytes(sum(s * len(ff) for s, ff in results))))
+        sys.exit()
+    results, linked, stats = [], [], {} # [(size, files), ], [..], {..}
+    try:
+        for size, files in find_duplicates(linked=linked, index=index,
+                                           stats=stats, **vars(args)):
+            if not results:
+                kind = "files and directories" if args.dirs else "files"
+                print("\nDuplicate %s:" % kind)
+            results += [(size, files)]
+            print("%s [%s]:\n  %s" % (format_bytes(size), len(files),
+                  "\n  ".join(files)))
     finally:
+        if linked: print("\nAlready linked files:")
+        for size, files in linked:
+            print("%s [%s]:\n  %s" % (format_bytes(size), len(files),
+                  "\n  ".join(files)))
         print("\nDuplicates in total: %s, with %s of content." % (
               sum(len(ff) for s, ff in results),
               format_bytes(sum(s * len(ff) for s, ff in results))))
+        if stats.get("prefiltered"):
+            print("Prefilter saved reading up to %s: excluded %s from full "
+                  "comparison by sampling %s." % (
+                  format_bytes(max(0, stats["prefiltered"] - stats["sampled"])),
+                  format_bytes(stats["prefiltered"]),
+                  format_bytes(stats["sampled"])))
+        if args.cache:
+            print("Cache reused %s stored values, hashing read %s, "
+                  "%s entries pruned." % (stats.get("cachehits", 0),
+                  format_bytes(stats.get("hashed", 0)), stats.get("pruned", 0)))
+        if linked:
+            print("Already linked in total: %s, sharing %s of content." % (
+                  sum(len(ff) for s, ff in linked),
+                  format_bytes(sum(s * (len(ff) - 1) for s, ff in linked))))
+
+    if watch:
+        print("\nWatching for new duplicate files, press Ctrl-C to stop.")
+        try:
+            for size, files in watch_duplicates(args.paths, args.wildcards,
+                    args.recursive, index, args.maxopen, args.maxblock):
+                print("%s [%s]:\n  %s" % (format_bytes(size), len(files),
+                      "\n  ".join(files)))
+                sys.stdout.flush()
+        except KeyboardInterrupt: pass
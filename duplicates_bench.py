@@ -0,0 +1,259 @@
+#-*- coding: utf-8 -*-
+"""
+Benchmarks duplicates.py on generated file trees: times find_duplicates()
+end to end and by phase, measures bytes read and peak memory use.
+
+Each run is done in a separate process, results are printed and can be
+appended to a file as JSON lines, for comparing with later runs.
+
+------------------------------------------------------------------------------
+Released under the Creative Commons CC0 1.0 Universal Public Domain Dedication.
+
+@author      Erki Suurjaak
+@created     16.10.2026
+@modified    16.10.2026
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+try: import resource
+except ImportError: resource = None # Windows
+
+import duplicates
+
+ARGUMENTS = {
+    "description": "Benchmark duplicates.py on a generated file tree. "
+                   "Options after -- are passed to duplicates.py, "
+                   "subdirectories are always processed.",
+    "arguments": [
+        {"args": ["-d", "--directory"], "dest": "directory",
+         "metavar": "DIR", "help": "directory to generate tree in and keep, "
+                                   "or to benchmark as-is if not empty, "
+                                   "temporary directory by default"},
+        {"args": ["-f", "--files"], "type": int, "default": 1000,
+         "help": "number of files to generate (default %(default)s)"},
+        {"args": ["--dirs"], "type": int,
+         "help": "number of directories to generate (default files/10)"},
+        {"args": ["--depth"], "type": int, "default": 5,
+         "help": "maximum directory nesting depth (default %(default)s)"},
+        {"args": ["--minsize"], "type": int, "default": 1024,
+         "help": "minimum file size in bytes (default %(default)s)"},
+        {"args": ["--maxsize"], "type": int, "default": 262144,
+         "help": "maximum file size in bytes (default %(default)s)"},
+        {"args": ["--collisions"], "type": float, "default": 0.5,
+         "metavar": "RATIO", "help": "share of files having the same size as "
+                                     "an earlier file (default %(default)s)"},
+        {"args": ["--duplicates"], "type": float, "default": 0.5,
+         "metavar": "RATIO", "help": "share of size-colliding files having "
+                                     "identical content (default %(default)s)"},
+        {"args": ["--prefix"], "type": int, "default": 0, "metavar": "BYTES",
+         "help": "bytes of content that size-colliding files share "
+                 "before differing (default %(default)s)"},
+        {"args": ["--hardlinks"], "type": float, "default": 0,
+         "metavar": "RATIO", "help": "share of files hardlinked to an "
+                                     "earlier file (default %(default)s)"},
+        {"args": ["--seed"], "type": int,
+         "help": "random seed for tree layout and sizes"},
+        {"args": ["-n", "--repeat"], "type": int, "default": 3,
+         "help": "number of runs (default %(default)s)"},
+        {"args": ["-o", "--output"], "metavar": "FILE",
+         "help": "file to append results to, as JSON lines"},
+        {"args": ["--compare"], "nargs": 2, "metavar": ("OLD", "NEW"),
+         "help": "compare averages in two results files and exit"},
+        {"args": ["--run"], "help": argparse.SUPPRESS},
+    ],
+}
+METRICS = ["total", "walk", "stat", "group", "compare", "read", "diskread",
+           "peakrss"] # Measurements to report and compare, in this order
+
+
+def generate_tree(path, files=1000, dirs=None, depth=5, minsize=1024,
+                  maxsize=262144, collisions=0.5, duplicates=0.5, prefix=0,
+                  hardlinks=0, seed=None):
+    """
+    Creates a tree of random files under path.
+
+    @param   files       number of files to create
+    @param   dirs        number of directories to create, files/10 if None
+    @param   depth       maximum directory nesting depth
+    @param   collisions  share of files with the same size as an earlier file
+    @param   duplicates  share of size-colliding files with the same content
+    @param   prefix      bytes of content shared by size-colliding files
+                         before differing at a random offset
+    @param   hardlinks   share of files hardlinked to an earlier file
+    @param   seed        random seed for layout and sizes, content is
+                         always random
+    @return              {"files", "dirs", "bytes", "duplicates", "links"}
+    """
+    rnd, stats = random.Random(seed), dict.fromkeys(["files", "dirs", "bytes",
+                                                     "duplicates", "links"], 0)
+    folders = [(path, 0)] # [(path, depth), ]
+    for i in range(files // 10 if dirs is None else dirs):
+        parent, level = rnd.choice([x for x in folders if x[1] < depth]
+                                   or folders[:1])
+        folders.append((os.path.join(parent, "d%s" % i), level + 1))
+        os.makedirs(folders[-1][0])
+    stats["dirs"] = len(folders) - 1
+
+    made = [] # [(path, size), ]
+    for i in range(files):
+        filename = os.path.join(rnd.choice(folders)[0], "f%s.dat" % i)
+        choice, base = rnd.random(), made and rnd.choice(made)
+        if base and choice < hardlinks and hasattr(os, "link"):
+            os.link(base[0], filename)
+            stats["links"] += 1
+            continue # for i
+        if base and choice < hardlinks + collisions:
+            size = base[1]
+            with open(base[0], "rb") as f:
+                if not size or rnd.random() < duplicates:
+                    data = f.read()
+                    stats["duplicates"] += 1
+                else: # Same prefix, then differing at a random offset after
+                    data = f.read(min(prefix, size - 1))
+                    pos = rnd.randint(len(data), size - 1)
+                    data += os.urandom(pos - len(data))
+                    f.seek(pos)
+                    data += chr(ord(f.read(1)) ^ 0xFF)
+                    data += os.urandom(size - len(data))
+        else:
+            size = rnd.randint(minsize, maxsize)
+            data = os.urandom(size)
+        with open(filename, "wb") as f: f.write(data)
+        made.append((filename, size))
+        stats["bytes"] += size
+    stats["files"] = len(made) + stats["links"]
+    return stats
+
+
+def get_io():
+    """
+    Returns {"read": bytes read, "diskread": bytes read from storage}
+    for the current process, or {} if not available (Linux only).
+    Reads from memory-mapped files are only reflected in "diskread".
+    """
+    result = {}
+    try:
+        with open("/proc/self/io") as f:
+            data = dict(x.split(":") for x in f if ":" in x)
+        result = {"read": int(data["rchar"]),
+                  "diskread": int(data["read_bytes"])}
+    except (EnvironmentError, KeyError, ValueError): pass
+    return result
+
+
+def run_benchmark(**kwargs):
+    """
+    Runs duplicates.find_duplicates() once with given keyword arguments,
+    returns measurements: {"total", "walk", "stat", "group", "compare": seconds,
+    "read", "diskread", "peakrss": bytes or None, "groups", "duplicates"}.
+    """
+    stats, io1 = {}, get_io()
+    clock = time.time()
+    groups = list(duplicates.find_duplicates(stats=stats, **kwargs))
+    total, io2 = time.time() - clock, get_io()
+    result = {"total": total, "walk": stats.get("walktime"),
+              "stat": stats.get("stattime"), "group": stats.get("grouptime"),
+              "groups": len(groups),
+              "duplicates": sum(len(ff) for _, ff in groups)}
+    result["compare"] = total - sum(result[k] or 0
+                                    for k in ("walk", "stat", "group"))
+    for k in "read", "diskread": result[k] = io2.get(k, 0) - io1.get(k, 0) \
+                                             if k in io2 else None
+    result["peakrss"] = None
+    if resource: # Linux reports kilobytes, macOS bytes
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        result["peakrss"] = rss if "darwin" == sys.platform else rss * 1024
+    return result
+
+
+def compare_results(old, new):
+    """Prints average measurements from two results files side by side."""
+    def average(filename):
+        runs = [json.loads(x) for x in open(filename) if x.strip()]
+        return runs, dict((k, sum(x[k] for x in runs) / float(len(runs)))
+                          for k in METRICS if runs and all(x.get(k) is not None
+                                                           for x in runs))
+    (runs1, avg1), (runs2, avg2) = average(old), average(new)
+    print("%-10s %14s %14s %9s" % ("", "%s runs" % len(runs1),
+                                   "%s runs" % len(runs2), "change"))
+    for k in (x for x in METRICS if x in avg1 and x in avg2):
+        fmt = (lambda v: "%.3f s" % v) if k not in ("read", "diskread",
+               "peakrss") else (lambda v: duplicates.format_bytes(v))
+        change = "%+.1f%%" % ((avg2[k] - avg1[k]) * 100. / avg1[k]) \
+                 if avg1[k] else ""
+        print("%-10s %14s %14s %9s" % (k, fmt(avg1[k]), fmt(avg2[k]), change))
+
+
+
+if "__main__" == __name__:
+    argv = sys.argv[1:]
+    options = argv[argv.index("--") + 1:] if "--" in argv else []
+    argv = argv[:argv.index("--")] if "--" in argv else argv
+    parser = argparse.ArgumentParser(description=ARGUMENTS["description"])
+    for a in ARGUMENTS["arguments"]: parser.add_argument(*a.pop("args"), **a)
+    args = parser.parse_args(argv)
+
+    if args.run: # Child process: run once and print results as JSON
+        print(json.dumps(run_benchmark(**json.loads(args.run))))
+        sys.exit()
+    if args.compare:
+        compare_results(*args.compare)
+        sys.exit()
+
+    dupparser = argparse.ArgumentParser(prog="duplicates.py")
+    dupparser.set_defaults(recursive=True)
+    for a in duplicates.ARGUMENTS["arguments"]:
+        if "-d" not in a["args"]: dupparser.add_argument(*a.pop("args"), **a)
+    dupargs = dupparser.parse_args(options)
+    for filetype in dupargs.types or []:
+        dupargs.wildcards += duplicates.TYPEGROUPS[filetype]
+    dupargs.prefilter = not dupargs.noprefilter
+    for k in ("types", "noprefilter", "watch", "manifest", "merge",
+              "nomanifesthash"):
+        delattr(dupargs, k)
+
+    path = args.directory or tempfile.mkdtemp(prefix="duplicates_bench.")
+    tree = None
+    try:
+        if not os.path.isdir(path) or not os.listdir(path):
+            print("Generating %s files in %s." % (args.files, path))
+            kwargs = dict((k, getattr(args, k)) for k in ("files", "dirs",
+                          "depth", "minsize", "maxsize", "collisions",
+                          "duplicates", "prefix", "hardlinks", "seed"))
+            tree = dict(kwargs, **generate_tree(path, **kwargs))
+            print("Generated %s files (%s duplicates, %s hardlinks) in %s "
+                  "directories, %s in total." % (tree["files"],
+                  tree["duplicates"], tree["links"], tree["dirs"],
+                  duplicates.format_bytes(tree["bytes"])))
+        dupargs.paths = [path]
+        header = {"host": socket.gethostname(), "options": options,
+                  "python": sys.version.split()[0], "tree": tree}
+        cmd = [sys.executable, os.path.abspath(__file__), "--run",
+               json.dumps(vars(dupargs))]
+        print("%-4s %9s %9s %9s %9s %9s %11s %11s" % ("run", "total", "walk",
+              "stat", "group", "compare", "read", "peak RSS"))
+        for i in range(args.repeat):
+            result = json.loads(subprocess.check_output(cmd).splitlines()[-1])
+            fmt = lambda k: "%.3f" % result[k] if result[k] is not None else "-"
+            size = lambda k: duplicates.format_bytes(result[k]) \
+                             if result[k] is not None else "-"
+            print("%-4s %9s %9s %9s %9s %9s %11s %11s" % (i + 1, fmt("total"),
+                  fmt("walk"), fmt("stat"), fmt("group"), fmt("compare"),
+                  size("read"), size("peakrss")))
+            result.update(header, run=i + 1,
+                          created=datetime.datetime.now().isoformat())
+            if args.output:
+                with open(args.output, "a") as f:
+                    f.write(json.dumps(result, sort_keys=True) + "\n")
+    except KeyboardInterrupt: pass
+    finally:
+        if not args.directory: shutil.rmtree(path, ignore_errors=True)